@@ -3,18 +3,23 @@
 # new BSD license
 
 import codecs
-import copy
+from collections import OrderedDict
 import glob
+import hashlib
 import os
 import json
 import logging
+import multiprocessing
 from Queue import Queue, Empty
+import notes_index
+import notes_store
+import notes_watcher
 import re
 import simplenote
 simplenote.NOTE_FETCH_LENGTH=100
 from simplenote import Simplenote
 
-from threading import Thread
+from threading import Condition, Event, Lock, RLock, Thread
 import time
 import utils
 
@@ -22,6 +27,13 @@ ACTION_SAVE = 0
 ACTION_SYNC_PARTIAL_TO_SERVER = 1
 ACTION_SYNC_PARTIAL_FROM_SERVER = 2 # UNUSED.
 
+# the save worker writes at most this many notes before flushing them.
+SAVE_BATCH_SIZE = 64
+
+# with load_processes, note files larger than this many bytes are decoded in
+# a separate process. for smaller ones, that costs more than it saves.
+LOAD_PROCESS_SIZE = 256 * 1024
+
 class SyncError(RuntimeError):
     pass
 
@@ -31,9 +43,147 @@ class ReadError(RuntimeError):
 class WriteError(RuntimeError):
     pass
 
+class SaveScheduler:
+    """Pending note saves for the save worker, keyed by local key.
+
+    Scheduling a save for a note that is still waiting to be written
+    replaces the older version. Each note is written at most once every
+    interval seconds, no matter how often it is scheduled, until flush()
+    makes everything due at once.
+
+    @ivar pending: dictionary mapping local key to scheduled save.
+    @ivar due: dictionary mapping local key to time its save is due.
+    @ivar last_written: dictionary mapping local key to time the worker
+    last took a save for it.
+    @ivar in_flight: list of local keys of saves taken by the worker, but
+    not yet written.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.cond = Condition()
+        self.pending = {}
+        self.due = {}
+        self.last_written = {}
+        self.in_flight = []
+
+    def put(self, o):
+        """Schedule save o, with o.key the local key of the note.
+        """
+
+        with self.cond:
+            self.pending[o.key] = o
+            if o.key not in self.due:
+                self.due[o.key] = max(time.time(), self.last_written.get(o.key, 0) + self.interval)
+
+            self.cond.notify_all()
+
+    def get_batch(self, max_saves):
+        """Wait until saves are due, and return them.
+
+        The caller has to call task_done() once they have been written.
+
+        @param max_saves: return at most this many saves.
+        @returns: non-empty list of saves.
+        """
+
+        with self.cond:
+            while True:
+                if not self.due:
+                    self.cond.wait()
+                    continue
+
+                now = time.time()
+                keys = [k for k, t in self.due.items() if t <= now]
+                if not keys:
+                    self.cond.wait(min(self.due.values()) - now)
+                    continue
+
+                keys.sort(key=self.due.get)
+                del keys[max_saves:]
+
+                # we only need to remember recent writes
+                if len(self.last_written) > 1000:
+                    self.last_written = dict([(lk, t) for lk, t in self.last_written.items()
+                                              if t > now - self.interval])
+
+                for k in keys:
+                    del self.due[k]
+                    self.last_written[k] = now
+
+                self.in_flight.extend(keys)
+                return [self.pending.pop(k) for k in keys]
+
+    def task_done(self, keys):
+        """Record that the saves of keys, as returned by get_batch(), have
+        been written.
+        """
+
+        with self.cond:
+            for k in keys:
+                self.in_flight.remove(k)
+
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Make all pending saves due now, and wait until they're written.
+
+        @param timeout: wait at most this many seconds, None for no limit.
+        @returns: True if everything was written.
+        """
+
+        with self.cond:
+            for k in self.due:
+                self.due[k] = 0
+
+            self.cond.notify_all()
+
+            if timeout is not None:
+                end = time.time() + timeout
+
+            while self.pending or self.in_flight:
+                if timeout is None:
+                    self.cond.wait()
+
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+
+                    self.cond.wait(remaining)
+
+            return True
+
+    def qsize(self):
+        """Number of saves that are pending or being written.
+        """
+
+        with self.cond:
+            return len(self.pending) + len(self.in_flight)
+
+    def __contains__(self, k):
+        """Is a save of note k pending or being written?
+        """
+
+        with self.cond:
+            return k in self.pending or k in self.in_flight
+
 class NotesDB(utils.SubjectMixin):
     """NotesDB will take care of the local notes database and syncing with SN.
     """
+
+    regexp_special_chars = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    # incremental syncs can't see notes that were deleted for good on the
+    # server, so we still get the full index at least this often (seconds).
+    FULL_INDEX_INTERVAL = 24 * 3600
+    # the server's modifydate of a note comes from the client that edited
+    # it, so a note that was edited offline can reach the server long after
+    # our cursor went past its modifydate. incremental syncs look this far
+    # (seconds) behind the cursor. notes that were edited even longer
+    # before they got synced are only seen by the next full index.
+    SYNC_CURSOR_MARGIN = 7 * 24 * 3600
+
     def __init__(self, config):
         utils.SubjectMixin.__init__(self)
         
@@ -50,102 +200,248 @@ class NotesDB(utils.SubjectMixin):
             os.mkdir(config.txt_path)
         
         now = time.time()    
-        # now read all .json files from disk
-        fnlist = glob.glob(self.helper_key_to_fname('*'))
+        # with lazy content, only the contents of the most recently used
+        # notes stay in memory, see helper_resident_note(), and notes that
+        # did not change are read from the metadata cache at startup. the snapshot and
+        # the write-ahead log would need every note's content in memory.
+        self.content_lru = None
+        if self.config.db_lazy_content:
+            if self.config.db_snapshot or self.config.db_wal:
+                logging.error('NotesDB: db_lazy_content can not be combined with db_snapshot or db_wal')
+            else:
+                self.content_lru = OrderedDict()
+
+        # the snapshot, if enabled and still valid, replaces globbing and
+        # parsing all the .json files with one sequential read.
+        self.snapshot_valid = False
+        snapshot_fn = self.helper_snapshot_fname()
+        snapshot_notes = None
+        if self.config.db_snapshot and os.path.isfile(snapshot_fn):
+            try:
+                snapshot_notes = notes_store.read_snapshot(snapshot_fn)
+
+            except (IOError, ValueError), e:
+                # the .json files are still there, so we fall back to them.
+                logging.error('NotesDB_init: Error reading snapshot %s: %s' % (snapshot_fn, str(e)))
+
+            else:
+                self.snapshot_valid = True
+
+        # loaded maps local key to note, note_sources maps local key to the
+        # file the note was read from, for comparison with text notes.
+        if snapshot_notes is not None:
+            fnlist = []
+            loaded = snapshot_notes
+            # every note and text note was saved before the snapshot was
+            # written, so its mtime stands in for that of the .json files.
+            note_sources = dict.fromkeys(loaded, snapshot_fn)
+            cached_titles = {}
+
+        else:
+            # now read all .json files from disk
+            fnlist = glob.glob(self.helper_key_to_fname('*'))
+            if self.content_lru is not None:
+                loaded, note_sources, cached_titles = self.helper_load_note_metadata(fnlist)
+
+            else:
+                loaded, note_sources = self.helper_load_note_files(fnlist)
+                cached_titles = {}
+
+        # walseq is kept out of the notes, so that it never goes to the
+        # server. files from an earlier session in wal mode can have it.
+        walseqs = notes_store.pop_walseqs(loaded)
+
+        # in wal mode, everything saved since the last compaction is in the
+        # write-ahead log, which we replay on top of what we've just read.
+        if self.config.db_wal:
+            for k in self.helper_wal_replay(loaded, walseqs):
+                if k in loaded:
+                    note_sources[k] = self.helper_wal_fname()
+
         txtlist = glob.glob(unicode(self.config.txt_path + '/*.txt', 'utf-8'))
         txtlist += glob.glob(unicode(self.config.txt_path + '/*.mkdn', 'utf-8'))
 
         # removing json files and force full full sync if using text files
         # and none exists and json files are there
-        if self.config.notes_as_txt and not txtlist and fnlist:
+        if self.config.notes_as_txt and not txtlist and loaded:
             logging.debug('Forcing resync: using text notes, first usage')
+            if snapshot_notes is not None:
+                fnlist = glob.glob(self.helper_key_to_fname('*'))
+                self.helper_invalidate_snapshot()
+
             for fn in fnlist:
                 os.unlink(fn)
-            fnlist = []
+
+            if self.config.db_wal:
+                self.wal.truncate()
+
+            loaded = {}
 
         self.notes = {}
         if self.config.notes_as_txt:
-            self.titlelist = {}
-
-        for fn in fnlist:
+            # local key <-> name of the note's file in txt_path
+            self.titlelist = notes_index.NameIndex()
+
+        # search indexes, kept up to date by helper_note_changed()
+        self.active_keys = set()
+        # normalized (lowercased) content per note for case insensitive
+        # searching and indexing, see helper_normalized_content()
+        self.normalized_content = {}
+        # note titles, see get_note_title(), and text filenames, see
+        # get_note_title_file()
+        self.titles = {}
+        self.title_files = {}
+        # local key <-> title, see get_keys_by_title()
+        self.title_index = notes_index.NameIndex()
+        fold = self.config.search_normalize == 'fold'
+        self.search_db = None
+        if self.content_lru is not None:
+            # with lazy content, the indexes are kept on disc, and they
+            # remember which notes they already indexed in earlier sessions.
+            fn = self.helper_search_index_fname()
             try:
-                n = json.load(open(fn, 'rb'))
-                if self.config.notes_as_txt:
-                    nt = utils.get_note_title_file(n)
-                    tfn = os.path.join(self.config.txt_path, nt)
-                    if os.path.isfile(tfn):
-                        self.titlelist[n.get('key')] = nt
-                        txtlist.remove(tfn)
-                        if os.path.getmtime(tfn) > os.path.getmtime(fn):
-                            logging.debug('Text note was changed: %s' % (fn,))
-                            with codecs.open(tfn, mode='rb', encoding='utf-8') as f:  
-                                c = f.read()
-
-                            n['content'] = c
-                            n['modifydate'] = os.path.getmtime(tfn)
+                self.search_db = notes_store.open_search_index(fn)
+                self.word_index = notes_index.StoredWordIndex(
+                    notes_store.PostingsStore(self.search_db, 'word', True), fold)
+                self.trigram_index = notes_index.StoredTrigramIndex(
+                    notes_store.PostingsStore(self.search_db, 'trigram'), fold)
+
+            except notes_store.SearchIndexError, e:
+                logging.error('NotesDB_init: Error opening search index %s: %s' % (fn, str(e)))
+                self.search_db = None
+
+        if self.search_db is None:
+            self.word_index = notes_index.WordIndex(fold)
+            self.trigram_index = notes_index.TrigramIndex(fold)
+
+        # contents of non-resident notes read by recent searches, see
+        # helper_note_content()
+        self.search_content = OrderedDict()
+        # notes in each sort order, see helper_sorted_view()
+        self.sorted_views = {}
+        # local keys of changed notes for each periodic consumer, see
+        # get_changed_keys()
+        self.change_journals = {'save' : set(), 'sync' : set(), 'view' : set()}
+        # incremented with each change, see helper_refined_candidates()
+        self.notes_generation = 0
+        self.last_filter = None
+
+        # the text files of all notes are looked up, and read when they were
+        # changed, on the load threads.
+        if self.config.notes_as_txt:
+            txt_items = [(localkey, note_sources[localkey],
+                          cached_titles[localkey][1] if localkey in cached_titles else utils.get_note_title_file(n))
+                         for localkey, n in loaded.items()]
+            txt_notes = {}
+            for item, r in self.helper_load_imap(self.helper_read_txt_note, txt_items):
+                txt_notes[item[0]] = r
+
+            # text files without a note are new notes
+            txtset = set(txtlist)
+
+        for localkey, n in loaded.items():
+            fn = note_sources[localkey]
+            txt_changed = False
+            if self.config.notes_as_txt:
+                txt_note = txt_notes[localkey]
+                if txt_note is not None:
+                    tfn, mtime, c = txt_note
+                    self.titlelist.set_name(localkey, os.path.basename(tfn))
+                    txtset.discard(tfn)
+                    if c is not None:
+                        logging.debug('Text note was changed: %s' % (fn,))
+                        n['content'] = c
+                        n['modifydate'] = mtime
+                        txt_changed = True
+                else:
+                    logging.debug('Deleting note : %s' % (fn,))
+                    if not self.config.simplenote_sync:
+                        jfn = self.helper_key_to_fname(localkey)
+                        if os.path.isfile(jfn):
+                            os.unlink(jfn)
+                        self.helper_invalidate_snapshot()
+                        continue
                     else:
-                        logging.debug('Deleting note : %s' % (fn,))
-                        if not self.config.simplenote_sync:
-                            os.unlink(fn)
-                            continue
-                        else:
-                            n['deleted'] = 1
-                            n['modifydate'] = now
-
-            except IOError, e:
-                logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
-                raise ReadError ('Error opening note file')
+                        n['deleted'] = 1
+                        n['modifydate'] = now
 
-            except ValueError, e:
-                logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
-                raise ReadError ('Error reading note file')
+            self.notes[localkey] = n
+            # we maintain in memory a timestamp of the last save
+            # these notes have just been read, so at this moment
+            # they're in sync with the disc, except for the .json files
+            # of changed text notes.
+            n['savedate'] = 0 if txt_changed else now
 
-            else:
-                # we always have a localkey, also when we don't have a note['key'] yet (no sync)
-                localkey = os.path.splitext(os.path.basename(fn))[0]
-                self.notes[localkey] = n
-                # we maintain in memory a timestamp of the last save
-                # these notes have just been read, so at this moment
-                # they're in sync with the disc.
-                n['savedate'] = now
+        for k in self.notes:
+            self.helper_note_changed(k)
+
+        # titles of the notes we didn't have to read
+        for k, (t, nt) in cached_titles.items():
+            n = self.notes.get(k)
+            if n is not None and 'content' not in n:
+                self.titles[k] = t
+                self.title_files[k] = nt
         
         if self.config.notes_as_txt:
-            for fn in txtlist:
+            def read_txt(tfn):
+                with codecs.open(tfn, mode='rb', encoding='utf-8') as f:
+                    return f.read()
+
+            # new notes are created in a fixed order, whichever file is
+            # read first.
+            new_txt = dict(self.helper_load_imap(read_txt, txtset))
+            for fn in sorted(new_txt):
                 logging.debug('New text note found : %s' % (fn),)
                 tfn = os.path.join(self.config.txt_path, fn)
-                try:
-                    with codecs.open(tfn, mode='rb', encoding='utf-8') as f:  
-                        c = f.read()
-
-                except IOError, e:
-                    logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
-                    raise ReadError ('Error opening note file')
-
-                except ValueError, e:
-                    logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
-                    raise ReadError ('Error reading note file')
-
-                else:
-                    nk = self.create_note(c)
-                    nn = os.path.splitext(os.path.basename(fn))[0]
-                    if nn != utils.get_note_title(self.notes[nk]):
-                        self.notes[nk]['content'] = nn + "\n\n" + c
-
-                    os.unlink(tfn)
-
+                self.helper_create_txt_note(tfn, new_txt[fn])
+                os.unlink(tfn)
+
+        # text files are watched for changes by other programs, see
+        # apply_txt_changes(). txt_written maps text filename to the sha1 of
+        # what we last wrote to it ourselves, once it is on disc. it is
+        # shared with the save thread, under the lock of titlelist.
+        self.txt_watcher = None
+        self.txt_written = {}
+        if self.config.notes_as_txt and self.config.txt_watch:
+            self.txt_watcher = notes_watcher.create_watcher(
+                unicode(self.config.txt_path, 'utf-8'), ('.txt', '.mkdn'))
+
+
+        if self.config.db_wal:
+            # the save worker logs each note against its last logged
+            # version, which we keep here.
+            self.wal_shadow = dict((k, self.helper_copy_note(n)) for k, n in self.notes.items())
+            self.wal_lock = RLock()
+            # compactions run one at a time, see helper_wal_compact().
+            self.wal_compact_lock = Lock()
+            self.wal_compact_event = Event()
+
+            thread_wal_compact = Thread(target=self.worker_wal_compact)
+            thread_wal_compact.setDaemon(True)
+            thread_wal_compact.start()
+
+        self.durability = self.config.db_durability
+        if self.durability not in notes_store.DURABILITY_LEVELS:
+            logging.error('NotesDB: Unknown db_durability %s, using %s' %
+                          (self.durability, notes_store.DURABILITY_BATCH))
+            self.durability = notes_store.DURABILITY_BATCH
 
         # save and sync queue
-        self.q_save = Queue()
+        self.q_save = SaveScheduler(self.config.save_interval)
         self.q_save_res = Queue()
 
         thread_save = Thread(target=self.worker_save)
         thread_save.setDaemon(True)
         thread_save.start()
 
+        # everything is in memory right after reading
+        self.helper_evict_content()
+
         # initialise the simplenote instance we're going to use
         # this does not yet need network access
         if self.config.simplenote_sync:
-            self.simplenote = Simplenote(config.sn_username, config.sn_password)
+            self.simplenote = Simplenote(config.sn_username, config.sn_password,
+                                         config.http_pool_size, config.http_idle_timeout)
         
             # we'll use this to store which notes are currently being synced by
             # the background thread, so we don't add them anew if they're still
@@ -159,11 +455,127 @@ class NotesDB(utils.SubjectMixin):
 
             self.q_sync = Queue()
             self.q_sync_res = Queue()
+
+            # cursor of the last full sync, see sync_full_threaded()
+            self.sync_state = self.helper_load_sync_state()
+            self.sync_full_running = False
         
             thread_sync = Thread(target=self.worker_sync)
             thread_sync.setDaemon(True)
             thread_sync.start()
+
+        # we've just read everything from the .json files (and replayed the
+        # write-ahead log), so this is a good time to consolidate them for
+        # the next startup.
+        if (self.config.db_snapshot and not self.snapshot_valid) or \
+           (self.config.db_wal and (self.wal.size() > 0 or self.wal.rotated())):
+            self.checkpoint()
         
+    def apply_txt_changes(self):
+        """Bring the notes up to date with the text files in txt_path that
+        other programs created, changed or removed since the previous call.
+
+        This function is called by the housekeeping handler.
+
+        @returns: list of local keys of the notes that were created, changed
+        or deleted.
+        """
+
+        if self.txt_watcher is None:
+            return []
+
+        try:
+            changed_files = self.txt_watcher.poll()
+
+        except OSError, e:
+            logging.error('NotesDB: Error watching %s: %s' % (self.config.txt_path, str(e)))
+            return []
+
+        if not changed_files:
+            return []
+
+        txt_path = unicode(self.config.txt_path, 'utf-8')
+        changed = []
+        for fn in sorted(changed_files):
+            tfn = os.path.join(txt_path, fn)
+            k = None
+            for fk in sorted(self.titlelist.get_keys(fn)):
+                if fk in self.notes and not self.notes[fk].get('deleted'):
+                    k = fk
+                    break
+
+            try:
+                with open(tfn, 'rb') as f:
+                    data = f.read()
+
+            except IOError:
+                # the file was removed.
+                if k is not None:
+                    logging.debug('Text note was removed: %s' % (tfn,))
+                    self.delete_note(k)
+                    changed.append(k)
+
+                continue
+
+            with self.titlelist.lock:
+                written = self.txt_written.get(fn)
+
+            if written == hashlib.sha1(data).digest():
+                # we wrote this ourselves.
+                continue
+
+            if k is not None and (k in self.q_save or
+                                  float(self.notes[k].get('modifydate')) > float(self.notes[k].get('savedate'))):
+                # our own save of the note is still on its way, and would
+                # overwrite the file anyway. whatever we read here may well
+                # be the previous version we wrote ourselves.
+                logging.debug('Text note has a pending save: %s' % (tfn,))
+                continue
+
+            try:
+                c = data.decode('utf-8')
+
+            except UnicodeDecodeError, e:
+                logging.error('NotesDB: Error reading %s: %s' % (tfn, str(e)))
+                continue
+
+            if k is not None:
+                if c != self.get_note_content(k):
+                    logging.debug('Text note was changed: %s' % (tfn,))
+                    self.set_note_content(k, c)
+                    changed.append(k)
+
+            else:
+                logging.debug('New text note found : %s' % (tfn,))
+                nk = self.helper_create_txt_note(tfn, c)
+                if self.get_note_title_file(nk) == fn:
+                    # the next save writes the same file, so we keep it.
+                    self.titlelist.set_name(nk, fn)
+
+                else:
+                    os.unlink(tfn)
+
+                changed.append(nk)
+
+        return changed
+
+    def helper_create_txt_note(self, tfn, c):
+        """Create a note for a new text file with content c.
+
+        If the first line of c does not match the filename, the filename
+        becomes the title.
+
+        @returns: local key of the new note.
+        """
+
+        nk = self.create_note(c)
+        nn = os.path.splitext(os.path.basename(tfn))[0]
+        if nn != self.get_note_title(nk):
+            self.notes[nk]['content'] = nn + "\n\n" + c
+            self.helper_note_changed(nk)
+
+        return nk
+
     def create_note(self, title):
         # need to get a key unique to this database. not really important
         # what it is, as long as it's unique.
@@ -184,6 +596,7 @@ class NotesDB(utils.SubjectMixin):
                     }
         
         self.notes[new_key] = new_note
+        self.helper_note_changed(new_key)
         
         return new_key
     
@@ -191,6 +604,7 @@ class NotesDB(utils.SubjectMixin):
         n = self.notes[key]
         n['deleted'] = 1
         n['modifydate'] = time.time()
+        self.helper_note_changed(key)
 
     def filter_notes(self, search_string=None):
         """Return list of notes filtered with search string.
@@ -207,27 +621,54 @@ class NotesDB(utils.SubjectMixin):
         total number of notes in memory.
         """
 
+        if self.normalized_content and not self.helper_cache_normalized():
+            # the search settings changed, so the cache is of no use anymore.
+            self.normalized_content = {}
+
         if self.config.search_mode == 'regexp':
             filtered_notes, match_regexp, active_notes = self.filter_notes_regexp(search_string)
         else:
             filtered_notes, match_regexp, active_notes = self.filter_notes_gstyle(search_string)
 
-        if self.config.sort_mode == 0:
-            if self.config.pinned_ontop == 0:
-                # sort alphabetically on title
-                filtered_notes.sort(key=lambda o: utils.get_note_title(o.note))
-            else:
-                filtered_notes.sort(utils.sort_by_title_pinned)
-
-        else:
-            if self.config.pinned_ontop == 0:
-                # last modified on top
-                filtered_notes.sort(key=lambda o: -float(o.note.get('modifydate', 0)))
-            else:
-                filtered_notes.sort(utils.sort_by_modify_date_pinned, reverse=True)
+        # the sorted view already has all notes in the configured order, so
+        # we only have to pick out the ones we found.
+        view = self.helper_sorted_view()
+        by_key = dict([(o.key, o) for o in filtered_notes])
+        filtered_notes = [by_key[k] for k in view.order(by_key)]
 
         return filtered_notes, match_regexp, active_notes
 
+    def helper_sorted_view(self):
+        """Return up to date notes_index.SortedView for the configured
+        sort_mode and pinned_ontop.
+
+        Views are created when first needed, and then kept up to date.
+        """
+
+        sort_mode = self.config.sort_mode
+        pinned_ontop = self.config.pinned_ontop
+
+        view = self.sorted_views.get((sort_mode, pinned_ontop))
+        if view is None:
+            def sort_key(k, n):
+                if sort_mode == 0:
+                    # alphabetically on title
+                    sk = self.get_note_title(k)
+                else:
+                    # last modified on top
+                    sk = -float(n.get('modifydate', 0))
+
+                if pinned_ontop:
+                    return (1 - utils.note_pinned(n), sk)
+                else:
+                    return (sk,)
+
+            view = notes_index.SortedView(sort_key)
+            self.sorted_views[(sort_mode, pinned_ontop)] = view
+
+        view.refresh(self.notes)
+        return view
+
     def _helper_gstyle_tagmatch(self, tag_pats, note):
         if tag_pats:
             tags = note.get('tags')
@@ -317,21 +758,48 @@ class NotesDB(utils.SubjectMixin):
                 if gi[mi]:
                     tms_pats[mi-1].append(gi[mi])
 
-        for k in self.notes:
+        active_notes = len(self.active_keys)
+        if self.config.case_sensitive:
+            msword_pats = tms_pats[1] + tms_pats[2]
+        else:
+            fold = self.config.search_normalize == 'fold'
+            msword_pats = [notes_index.normalize(p, fold) for p in tms_pats[1] + tms_pats[2]]
+
+        # if the user has only added to the previous search, e.g. typed
+        # another character, only the previous results can still match.
+        query = (tms_pats[0], msword_pats)
+        candidates = self.helper_refined_candidates('gstyle', query, self._helper_gstyle_refines)
+
+        index_exact = False
+        if candidates is None:
+            # the word index gives us the notes that could match, so we only
+            # have to check those.
+            candidates = self.helper_index_candidates(self.word_index, tms_pats[1] + tms_pats[2])
+            # without case, the index finds exactly the notes that contain
+            # patterns consisting of a single word, so we don't have to look
+            # at their contents anymore.
+            index_exact = candidates is not None and not self.config.case_sensitive and \
+                next((p for p in msword_pats if notes_index.word_re.findall(p) != [p]), None) is None
+
+        if candidates is None:
+            candidates = self.active_keys
+
+        for k in candidates:
             n = self.notes[k]
 
             if not n.get('deleted'):
-                active_notes += 1
-                c = n.get('content')
+                tagmatch = self._helper_gstyle_tagmatch(tms_pats[0], n)
+                if not tagmatch:
+                    continue
 
-                # case insensitive mode: WARNING - SLOW!
-                if not self.config.case_sensitive and c:
-                    c = c.lower()
+                if index_exact:
+                    mswordmatch = True
+                elif self.config.case_sensitive:
+                    mswordmatch = self._helper_gstyle_mswordmatch(msword_pats, self.helper_note_content(k))
+                else:
+                    mswordmatch = self._helper_gstyle_mswordmatch(msword_pats, self.helper_normalized_content(k))
 
-                tagmatch = self._helper_gstyle_tagmatch(tms_pats[0], n)
-                # case insensitive mode: WARNING - SLOW!
-                msword_pats = tms_pats[1] + tms_pats[2] if self.config.case_sensitive else [p.lower() for p in tms_pats[1] + tms_pats[2]]
-                if tagmatch and self._helper_gstyle_mswordmatch(msword_pats, c):
+                if mswordmatch:
                     # we have a note that can go through!
 
                     # tagmatch == 1 if a tag was specced and found
@@ -340,8 +808,31 @@ class NotesDB(utils.SubjectMixin):
                     # we have to store our local key also
                     filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=tagfound))
 
+        self.helper_remember_filter('gstyle', query, filtered_notes)
+
         return filtered_notes, '|'.join(tms_pats[1] + tms_pats[2]), active_notes
 
+    def _helper_gstyle_refines(self, prev_query, query):
+        """Can query only match notes that prev_query matched too?
+
+        This is the case when every previous tag pattern is the prefix of a
+        new tag pattern, and every previous word pattern is contained in a
+        new word pattern.
+        """
+
+        prev_tag_pats, prev_msword_pats = prev_query
+        tag_pats, msword_pats = query
+
+        for ptp in prev_tag_pats:
+            if next((tp for tp in tag_pats if tp.startswith(ptp)), None) is None:
+                return False
+
+        for pp in prev_msword_pats:
+            if next((p for p in msword_pats if pp in p), None) is None:
+                return False
+
+        return True
+
 
     def filter_notes_regexp(self, search_string=None):
         """Return list of notes filtered with search_string, 
@@ -360,18 +851,31 @@ class NotesDB(utils.SubjectMixin):
         else:
             sspat = None
 
+        candidates = None
+        if sspat:
+            # plain strings can be refined just like gstyle words.
+            query = search_string if self.config.case_sensitive else search_string.lower()
+            candidates = self.helper_refined_candidates('regexp', query, self._helper_regexp_refines)
+
+            if candidates is None:
+                # the trigram index gives us the notes that the regexp could
+                # match, so we only have to run it on those.
+                candidates = self.helper_index_candidates(self.trigram_index,
+                    notes_index.regexp_trigram_query(search_string, self.trigram_index.fold))
+
+        if candidates is None:
+            candidates = self.active_keys
+
         filtered_notes = []
         # total number of notes, excluding deleted ones
-        active_notes = 0
-        for k in self.notes:
+        active_notes = len(self.active_keys)
+        for k in candidates:
             n = self.notes[k]
             # we don't do anything with deleted notes (yet)
             if n.get('deleted'):
                 continue
 
-            active_notes += 1
-
-            c = n.get('content')
+            c = self.helper_note_content(k)
             if self.config.search_tags == 1:
                 t = n.get('tags')
                 if sspat:
@@ -401,13 +905,115 @@ class NotesDB(utils.SubjectMixin):
 
         match_regexp = search_string if sspat else ''
 
+        if sspat:
+            self.helper_remember_filter('regexp', query, filtered_notes)
+
         return filtered_notes, match_regexp, active_notes
 
+    def _helper_regexp_refines(self, prev_query, query):
+        """Can regexp query only match notes that prev_query matched too?
+
+        We only know this for certain if neither contains special characters.
+        """
+
+        if self.regexp_special_chars.search(prev_query) or \
+           self.regexp_special_chars.search(query):
+            return False
+
+        return prev_query in query
+
+    def helper_index_candidates(self, index, query):
+        """Bring index up to date, and return its candidates for query.
+
+        @returns: set of local keys, or None if every note is a candidate,
+        also when the index could not be used.
+        """
+
+        try:
+            index.refresh(self.notes, self.helper_normalized_content)
+            return index.candidates(query)
+
+        except notes_store.SearchIndexError, e:
+            logging.error('NotesDB: Error using search index: %s' % (str(e),))
+            return None
+
+    def helper_refined_candidates(self, search_mode, query, refines):
+        """Return the keys found by the previous search if the new query can
+        only narrow down its results, else None.
+
+        @param refines: callable taking the previous and the new query, and
+        returning True if the new query refines the previous one.
+        """
+
+        lf = self.last_filter
+        if lf is None or lf.generation != self.notes_generation or \
+           lf.search_mode != search_mode or \
+           lf.case_sensitive != self.config.case_sensitive or \
+           lf.search_tags != self.config.search_tags:
+            return None
+
+        if refines(lf.query, query):
+            return lf.keys
+
+        return None
+
+    def helper_remember_filter(self, search_mode, query, filtered_notes):
+        """Remember search results for helper_refined_candidates().
+        """
+
+        self.last_filter = utils.KeyValueObject(
+            generation=self.notes_generation,
+            search_mode=search_mode,
+            case_sensitive=self.config.case_sensitive,
+            search_tags=self.config.search_tags,
+            query=query,
+            keys=set([o.key for o in filtered_notes]))
+
     def get_note(self, key):
-        return self.notes[key]
+        return self.helper_resident_note(key)
+
+    def get_note_title(self, key):
+        """Return title of note with local key.
+
+        The title is only extracted again when the note's content changes.
+        """
+
+        t = self.titles.get(key)
+        if t is None:
+            t = self.titles[key] = utils.get_note_title({'content' : self.helper_note_content(key)})
+
+        return t
+
+    def get_note_title_file(self, key):
+        """Return name of the text file of note with local key, or '' if
+        it has no title.
+
+        Like the title, this is only worked out again when the note changes.
+        """
+
+        fn = self.title_files.get(key)
+        if fn is None:
+            fn = self.title_files[key] = utils.note_title_to_file(
+                self.get_note_title(key), utils.note_markdown(self.notes[key]))
+
+        return fn
+
+    def get_keys_by_title(self, title):
+        """Return set of local keys of the non-deleted notes with title.
+        """
+
+        def title_of(k):
+            n = self.notes.get(k)
+            if n is None or n.get('deleted'):
+                return None
+
+            return self.get_note_title(k)
+
+        self.title_index.refresh(title_of)
+        return self.title_index.get_keys(title)
 
     def get_note_content(self, key):
-        return self.notes[key].get('content')
+        return self.helper_resident_note(key).get('content')
     
     def get_note_status(self, key):
         n = self.notes[key]
@@ -432,79 +1038,761 @@ class NotesDB(utils.SubjectMixin):
     def get_sync_queue_len(self):
         return self.q_sync.qsize()
         
-    def helper_key_to_fname(self, k):
-            return os.path.join(self.db_path, k) + '.json'
-    
-    def helper_save_note(self, k, note):
-        """Save a single note to disc.
-        
+    def helper_normalized_content(self, k):
+        """Return lowercased (and with search_normalize = fold, accent
+        stripped) content of note k.
+
+        While searching compares normalized content, see
+        helper_cache_normalized(), this is computed only once for each
+        version of the note's content.
         """
 
-        if self.config.notes_as_txt:
-            t = utils.get_note_title_file(note)
-            if t and not note.get('deleted'):
-                if k in self.titlelist:
-                    logging.debug('Writing note : %s %s' % (t,self.titlelist[k] ))
-                    if self.titlelist[k] != t:
-                        dfn = os.path.join(self.config.txt_path, self.titlelist[k])
-                        if os.path.isfile(dfn):
-                            logging.debug('Delete file %s ' % (dfn, ))
-                            os.unlink(dfn)
-                        else:
-                            logging.debug('File not exits %s ' % (dfn, ))
-                else:
-                    logging.debug('Key not in list %s ' % (k, ))
+        c = self.normalized_content.get(k)
+        if c is None:
+            c = notes_index.normalize(self.helper_note_content(k) or u'',
+                                      self.config.search_normalize == 'fold')
+            # with lazy content, only resident notes may be cached.
+            if self.helper_cache_normalized() and \
+               (self.content_lru is None or k in self.content_lru):
+                self.normalized_content[k] = c
+
+        return c
+
+    def helper_cache_normalized(self):
+        """Is normalized content worth keeping in memory?
+
+        Only case insensitive gstyle searches compare it with every
+        keystroke. Indexing needs it only once for each version of a note.
+        Regexp searches match the original content with re.I instead, since
+        lowercasing the user's pattern would turn escapes like \\S or \\W
+        into different ones, and folding accents would not fit patterns that
+        contain them.
+        """
 
-                self.titlelist[k] = t
-                fn = os.path.join(self.config.txt_path, t)
-                try:
-                    with codecs.open(fn, mode='wb', encoding='utf-8') as f:  
-                        c = note.get('content')
-                        if isinstance(c, str):
-                            c = unicode(c, 'utf-8')
-                        else:
-                            c = unicode(c)
-                        
-                        f.write(c)
-                except IOError, e:
-                    logging.error('NotesDB_save: Error opening %s: %s' % (fn, str(e)))
-                    raise WriteError ('Error opening note file')
+        return self.config.search_cache_normalized and not self.config.case_sensitive and \
+               self.config.search_mode != 'regexp'
 
-                except ValueError, e:
-                    logging.error('NotesDB_save: Error writing %s: %s' % (fn, str(e)))
-                    raise WriteError ('Error writing note file')
+    def helper_note_content(self, k):
+        """Return content of note k, reading it from its .json file if the
+        note is not resident, see helper_resident_note().
+
+        This does not make the note resident, so that searching does not
+        push the notes the user is working with out of memory. Instead, the
+        contents of the last content_cache_size notes read here are kept in
+        search_content, so that the search for the next keystroke does not
+        have to read them again.
+        """
+
+        n = self.notes[k]
+        if 'content' in n:
+            return n['content']
+
+        c = self.search_content.pop(k, None)
+        if c is not None:
+            self.search_content[k] = c
+            return c
 
-            elif t and note.get('deleted') and k in self.titlelist:
-                dfn = os.path.join(self.config.txt_path, self.titlelist[k])
-                if os.path.isfile(dfn):
-                    logging.debug('Delete file %s ' % (dfn, ))
-                    os.unlink(dfn)
-        
         fn = self.helper_key_to_fname(k)
-        if not self.config.simplenote_sync and note.get('deleted'):
-            if os.path.isfile(fn):
-                os.unlink(fn)
-        else:
-            json.dump(note, open(fn, 'wb'), indent=2)
+        try:
+            with open(fn, 'rb') as f:
+                c = notes_store.decode_note(f.read()).get('content')
 
-        # record that we saved this to disc.
-        note['savedate'] = time.time()
-        
-    def sync_note_unthreaded(self, k):
-        """Sync a single note with the server.
+        except IOError, e:
+            logging.error('NotesDB: Error opening %s: %s' % (fn, str(e)))
+            raise ReadError ('Error opening note file')
 
-        Update existing note in memory with the returned data.  
-        This is a sychronous (blocking) call.
+        except ValueError, e:
+            logging.error('NotesDB: Error reading %s: %s' % (fn, str(e)))
+            raise ReadError ('Error reading note file')
+
+        if c is not None:
+            self.search_content[k] = c
+            if len(self.search_content) > self.config.content_cache_size:
+                self.search_content.popitem(last=False)
+
+        return c
+
+    def helper_resident_note(self, k):
+        """Return note k with its content.
+
+        With db_lazy_content, notes only keep their content in memory while
+        they are among the content_cache_size most recently used ones.
+        Evicted notes are read back from their .json files here. Notes that
+        are handed to the worker threads have to be resident.
         """
 
-        note = self.notes[k]
-        
-        if not note.get('key') or float(note.get('modifydate')) > float(note.get('syncdate')):
-            # if has no key, or it has been modified sync last sync, 
-            # update to server
-            uret = self.simplenote.update_note(note)
+        n = self.notes[k]
+        if self.content_lru is not None:
+            if 'content' not in n:
+                n['content'] = self.helper_note_content(k)
+                self.search_content.pop(k, None)
 
-            if uret[1] == 0:
+            self.content_lru.pop(k, None)
+            self.content_lru[k] = True
+
+        return n
+
+    def helper_evict_content(self):
+        """Drop the contents of the least recently used notes from memory,
+        until at most content_cache_size are left.
+
+        Only notes whose content is on disc can be evicted: they must have
+        been saved since they were last changed or synced, and have no save
+        pending.
+        """
+
+        if self.content_lru is None:
+            return
+
+        excess = len(self.content_lru) - self.config.content_cache_size
+        for k in self.content_lru.keys():
+            if excess <= 0:
+                break
+
+            n = self.notes.get(k)
+            if n is not None:
+                savedate = float(n.get('savedate'))
+                if float(n.get('modifydate')) > savedate or \
+                   float(n.get('syncdate')) > savedate or k in self.q_save:
+                    continue
+
+                # the title is needed for the notes list, so we keep it.
+                self.get_note_title(k)
+                self.normalized_content.pop(k, None)
+                n.pop('content', None)
+
+            del self.content_lru[k]
+            excess -= 1
+
+    def helper_copy_note(self, n):
+        """Return a copy of note n that does not change when n does.
+
+        Notes are treated as copy-on-write records: values inside a note,
+        such as its tags list, are never changed in place, only replaced.
+        A shallow copy therefore shares the (possibly huge) content with n,
+        and still gives the worker threads a stable view of the note.
+        """
+
+        return dict(n)
+
+    def get_changed_keys(self, consumer):
+        """Return local keys of notes that were created, changed or removed
+        since the previous call, and forget them.
+
+        @param consumer: one of 'save', 'sync' or 'view'. Each consumer
+        gets to see every change.
+        @returns: set of local keys.
+        """
+
+        keys = self.change_journals[consumer]
+        self.change_journals[consumer] = set()
+        return keys
+
+    def helper_note_changed(self, k, content_changed=True):
+        """Record that note k was created, changed or removed.
+
+        This has to be called whenever self.notes or one of its notes is
+        changed, so that our indexes can be kept up to date.
+
+        @param content_changed: False if only the note's tags or other
+        metadata changed.
+        """
+
+        # this invalidates remembered search results
+        self.notes_generation += 1
+
+        n = self.notes.get(k)
+        if n is None or n.get('deleted'):
+            self.active_keys.discard(k)
+        else:
+            self.active_keys.add(k)
+
+        if self.content_lru is not None:
+            self.content_lru.pop(k, None)
+            if n is not None and 'content' in n:
+                self.content_lru[k] = True
+
+        # the markdown systemtag decides the filename extension
+        self.title_files.pop(k, None)
+
+        if content_changed:
+            self.search_content.pop(k, None)
+            self.normalized_content.pop(k, None)
+            self.titles.pop(k, None)
+            self.title_index.invalidate(k)
+            self.word_index.invalidate(k)
+
+        # the trigram index also covers tags
+        self.trigram_index.invalidate(k)
+
+        for view in self.sorted_views.values():
+            view.invalidate(k)
+
+        for journal in self.change_journals.values():
+            journal.add(k)
+
+    def helper_key_to_fname(self, k):
+            return os.path.join(self.db_path, k) + '.json'
+
+    def helper_load_imap(self, func, items):
+        """Apply func to items on the load threads, see utils.imap_threaded().
+
+        @raises ReadError: if func raised IOError, OSError or ValueError.
+        """
+
+        try:
+            for r in utils.imap_threaded(func, items, self.config.load_threads):
+                yield r
+
+        except (IOError, OSError), e:
+            logging.error('NotesDB_init: Error opening note file: %s' % (str(e),))
+            raise ReadError ('Error opening note file')
+
+        except ValueError, e:
+            logging.error('NotesDB_init: Error reading note file: %s' % (str(e),))
+            raise ReadError ('Error reading note file')
+
+    def helper_load_note_files(self, fnlist):
+        """Read and decode .json note files.
+
+        Files are read on the load threads. With load_processes, files larger
+        than LOAD_PROCESS_SIZE are decoded in a pool of that many processes,
+        and all others here, while the threads keep on reading. The pool is
+        only started if there are such files.
+
+        @param fnlist: list of .json filenames.
+        @returns: tuple of dictionary mapping local key to note and
+        dictionary mapping local key to the file the note was read from.
+        @raises ReadError: if a note file could not be read or decoded.
+        """
+
+        def read_file(fn):
+            with open(fn, 'rb') as f:
+                return f.read()
+
+        def is_large(fn):
+            try:
+                return os.path.getsize(fn) > LOAD_PROCESS_SIZE
+
+            except OSError:
+                # reading it will tell what is wrong
+                return False
+
+        loaded = {}
+        note_sources = {}
+        decoding = []
+        pool = None
+        try:
+            # the pool forks, so it has to be there before the load threads
+            # start: a child must not inherit a lock that some other thread
+            # holds.
+            if self.config.load_processes and \
+               next((fn for fn in fnlist if is_large(fn)), None) is not None:
+                pool = multiprocessing.Pool(self.config.load_processes)
+
+            for fn, data in self.helper_load_imap(read_file, fnlist):
+                # we always have a localkey, also when we don't have a note['key'] yet (no sync)
+                localkey = os.path.splitext(os.path.basename(fn))[0]
+                note_sources[localkey] = fn
+                if pool is not None and len(data) > LOAD_PROCESS_SIZE:
+                    decoding.append((localkey, pool.apply_async(notes_store.decode_note, (data,))))
+
+                else:
+                    try:
+                        loaded[localkey] = notes_store.decode_note(data)
+
+                    except ValueError, e:
+                        logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
+                        raise ReadError ('Error reading note file')
+
+            for localkey, r in decoding:
+                try:
+                    loaded[localkey] = r.get()
+
+                except ValueError, e:
+                    logging.error('NotesDB_init: Error reading %s: %s' % (note_sources[localkey], str(e)))
+                    raise ReadError ('Error reading note file')
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return loaded, note_sources
+
+    def helper_metadata_cache_fname(self):
+        # not .json, else we would read it as a note
+        return os.path.join(self.db_path, 'metadata.cache')
+
+    def helper_load_note_metadata(self, fnlist):
+        """Read the notes in fnlist without their content.
+
+        Only the .json files that changed since the last startup are read,
+        as told by their size, modification time and inode. For all others,
+        the metadata cache has the note without its content, its title and
+        its text filename. The cache is then updated.
+
+        @param fnlist: list of .json filenames.
+        @returns: tuple of dictionary mapping local key to note (with
+        content only if it was read), dictionary mapping local key to the
+        file the note was read from, and dictionary mapping local key of
+        notes without content to (title, text filename).
+        @raises ReadError: if a note file could not be read or decoded.
+        """
+
+        def stat_file(fn):
+            st = os.stat(fn)
+            # atomic writes replace the file, so the inode always changes.
+            return [st.st_mtime, st.st_size, st.st_ino]
+
+        cache_fn = self.helper_metadata_cache_fname()
+        cache = notes_store.read_metadata_cache(cache_fn)
+
+        stats = dict(self.helper_load_imap(stat_file, fnlist))
+
+        loaded = {}
+        note_sources = {}
+        cached_titles = {}
+        new_cache = {}
+        to_read = []
+        for fn in fnlist:
+            bfn = os.path.basename(fn)
+            entry = cache.get(bfn)
+            if entry is not None and entry[0] == stats[fn]:
+                localkey = os.path.splitext(bfn)[0]
+                loaded[localkey] = entry[1]
+                note_sources[localkey] = fn
+                cached_titles[localkey] = (entry[2], entry[3])
+                new_cache[bfn] = entry
+
+            else:
+                to_read.append(fn)
+
+        read, read_sources = self.helper_load_note_files(to_read)
+        for localkey, n in read.items():
+            fn = read_sources[localkey]
+            meta = dict(n)
+            meta.pop('content', None)
+            new_cache[os.path.basename(fn)] = [stats[fn], meta, utils.get_note_title(n),
+                                               utils.get_note_title_file(n)]
+
+        loaded.update(read)
+        note_sources.update(read_sources)
+
+        if new_cache != cache:
+            try:
+                notes_store.write_metadata_cache(cache_fn, new_cache)
+
+            except (IOError, OSError), e:
+                # next time we just read all notes again
+                logging.error('NotesDB_init: Error writing %s: %s' % (cache_fn, str(e)))
+
+        return loaded, note_sources, cached_titles
+
+    def helper_read_txt_note(self, item):
+        """Look up the text file of a note, on the load threads.
+
+        @param item: tuple of local key, file the note was read from and
+        text filename.
+        @returns: None if the note has no text file, else tuple of text
+        filename and, only if it is newer than the note, its modification
+        time and content, else None and None.
+        """
+
+        localkey, fn, nt = item
+        tfn = os.path.join(self.config.txt_path, nt)
+        if not os.path.isfile(tfn):
+            return None
+
+        mtime = os.path.getmtime(tfn)
+        if mtime <= os.path.getmtime(fn):
+            return tfn, None, None
+
+        with codecs.open(tfn, mode='rb', encoding='utf-8') as f:
+            return tfn, mtime, f.read()
+
+    def helper_encode_note(self, note):
+        """Serialize note for its .json file as set by db_compact and
+        db_compress_size.
+        """
+
+        return notes_store.encode_note(note, self.config.db_compact,
+                                       self.config.db_compress_size)
+
+    def helper_wal_fname(self):
+        return os.path.join(self.db_path, 'notes.wal')
+
+    def helper_wal_replay(self, notes, walseqs):
+        """Replay the write-ahead log on top of notes read from disc.
+
+        @param notes: dictionary mapping local key to note, updated in place.
+        @param walseqs: dictionary mapping local key to walseq of the notes,
+        see notes_store.pop_walseqs(). Kept as self.wal_seqs.
+        @return: list of local keys changed or removed by the log.
+        """
+
+        fn = self.helper_wal_fname()
+        self.wal = notes_store.WriteAheadLog(fn)
+
+        try:
+            records = self.wal.read_records()
+
+        except IOError, e:
+            logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
+            raise ReadError ('Error opening write-ahead log')
+
+        # a crash can leave a torn record at the end of the log, and a
+        # record that does not fit its note makes everything after it
+        # suspect. we keep what we can and cut the log off there.
+        changed = []
+        torn = self.wal.torn
+        for i, r in enumerate(records):
+            try:
+                changed.append(notes_store.wal_apply(notes, r, walseqs))
+
+            except (ValueError, KeyError, TypeError), e:
+                logging.warning('NotesDB_init: Invalid record in %s: %s' % (fn, str(e)))
+                records = records[:i]
+                torn = True
+                break
+
+        if torn:
+            logging.warning('NotesDB_init: Dropping %s after record %d' % (fn, len(records)))
+            try:
+                self.wal.truncate(len(records))
+
+            except (IOError, OSError), e:
+                logging.error('NotesDB_init: Error truncating %s: %s' % (fn, str(e)))
+                raise ReadError ('Error truncating write-ahead log')
+
+        # sequence numbers keep on increasing across compactions.
+        self.wal_seq = max([r['s'] for r in records] + walseqs.values() + [0])
+        self.wal_seqs = walseqs
+        # these have to be written to their .json files at the next compaction
+        self.wal_dirty = set([k for k in changed if k is not None])
+
+        return list(self.wal_dirty)
+
+    def helper_wal_save(self, k, note, batch=None):
+        """Append the changes to a note to the write-ahead log.
+
+        Can be called from the save worker and from the main thread.
+
+        @param note: note to save, or None if it should be removed.
+        @param batch: AtomicWriteBatch that flushes the log, or None.
+        """
+
+        with self.wal_lock:
+            if note is None:
+                if k not in self.wal_shadow:
+                    return
+
+                r = {'k' : k, 'x' : 1}
+                del self.wal_shadow[k]
+                self.wal_seqs.pop(k, None)
+
+            else:
+                r = notes_store.wal_record(k, self.wal_shadow.get(k), note)
+                if r is None:
+                    return
+
+                # the caller keeps on using note, so we keep our own copy.
+                self.wal_shadow[k] = self.helper_copy_note(note)
+
+            self.wal_seq += 1
+            r['s'] = self.wal_seq
+            if k in self.wal_shadow:
+                self.wal_seqs[k] = self.wal_seq
+
+            self.wal_dirty.add(k)
+
+            fn = self.helper_wal_fname()
+            try:
+                self.wal.append([r], batch)
+
+            except (IOError, OSError), e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (fn, str(e)))
+                raise WriteError ('Error writing write-ahead log')
+
+            if self.wal.size() > self.config.wal_compact_size:
+                # compacting takes a while, so the save worker leaves that
+                # to worker_wal_compact().
+                self.wal_compact_event.set()
+
+    def helper_wal_compact(self):
+        """Write all notes changed since the last compaction to their .json
+        files and the snapshot, then remove their write-ahead log.
+
+        The log is rotated first, so that saves can go on logging while the
+        notes are written.
+        """
+
+        with self.wal_compact_lock:
+            fn = self.helper_wal_fname()
+            with self.wal_lock:
+                try:
+                    self.wal.rotate()
+
+                except (IOError, OSError), e:
+                    logging.error('NotesDB_compact: Error rotating %s: %s' % (fn, str(e)))
+                    raise WriteError ('Error rotating write-ahead log')
+
+                dirty = self.wal_dirty
+                self.wal_dirty = set()
+                # the save worker replaces notes in wal_shadow, but never
+                # changes them, so a shallow copy stays as it is. their files
+                # get the walseq of the last record applied to them.
+                notes = dict([(k, dict(n, walseq=self.wal_seqs[k]) if k in self.wal_seqs else n)
+                              for k, n in self.wal_shadow.items()])
+                write_snapshot = self.config.db_snapshot and (dirty or not self.snapshot_valid)
+
+            try:
+                batch = notes_store.AtomicWriteBatch(self.durability)
+                for k in dirty:
+                    fn = self.helper_key_to_fname(k)
+                    n = notes.get(k)
+                    try:
+                        if n is None:
+                            batch.remove(fn)
+
+                        else:
+                            batch.write(fn, self.helper_encode_note(n))
+
+                    except (IOError, OSError), e:
+                        logging.error('NotesDB_compact: Error writing %s: %s' % (fn, str(e)))
+                        raise WriteError ('Error writing note file')
+
+                if write_snapshot:
+                    fn = self.helper_snapshot_fname()
+                    try:
+                        notes_store.write_snapshot(fn, notes, batch,
+                                                   self.config.db_compress_size)
+
+                    except (IOError, OSError), e:
+                        logging.error('NotesDB_compact: Error writing %s: %s' % (fn, str(e)))
+                        raise WriteError ('Error writing snapshot')
+
+                try:
+                    batch.commit()
+                    # only now that everything is on disc, the log can go.
+                    self.wal.remove_rotated()
+
+                except (IOError, OSError), e:
+                    logging.error('NotesDB_compact: Error flushing %s: %s' % (self.db_path, str(e)))
+                    raise WriteError ('Error flushing note files')
+
+            except WriteError:
+                # the rotated log still has these, so the next compaction
+                # has to try again.
+                with self.wal_lock:
+                    self.wal_dirty.update(dirty)
+
+                raise
+
+            if write_snapshot:
+                self.snapshot_valid = True
+
+    def worker_wal_compact(self):
+        while True:
+            self.wal_compact_event.wait()
+            self.wal_compact_event.clear()
+
+            try:
+                self.helper_wal_compact()
+
+            except WriteError, e:
+                logging.error('FATAL ERROR in access to file system')
+                print "FATAL ERROR: Check the nvpy.log"
+                os._exit(1)
+
+    def helper_sync_state_fname(self):
+        # not .json, else we would read it as a note
+        return os.path.join(self.db_path, 'sync.state')
+
+    def helper_load_sync_state(self):
+        """Read state persisted by the previous full sync.
+
+        @returns: dictionary with cursor, the latest server modifydate we
+        have seen, and full_index_date, when we last got the full index.
+        Empty if there is no valid state, so that we do a full sync.
+        """
+
+        fn = self.helper_sync_state_fname()
+        if not os.path.isfile(fn):
+            return {}
+
+        try:
+            with open(fn, 'rb') as f:
+                sync_state = json.load(f)
+
+        except (IOError, ValueError), e:
+            logging.error('NotesDB: Error reading sync state %s: %s' % (fn, str(e)))
+            return {}
+
+        if not isinstance(sync_state, dict):
+            return {}
+
+        return sync_state
+
+    def helper_save_sync_state(self):
+        fn = self.helper_sync_state_fname()
+        try:
+            notes_store.write_atomic(fn, json.dumps(self.sync_state))
+
+        except (IOError, OSError), e:
+            # next time we just do a complete sync again
+            logging.error('NotesDB: Error writing sync state %s: %s' % (fn, str(e)))
+
+    def helper_search_index_fname(self):
+        # not .json, else we would read it as a note
+        return os.path.join(self.db_path, 'search.index')
+
+    def helper_snapshot_fname(self):
+        return os.path.join(self.db_path, 'notes.snapshot')
+
+    def helper_delete_note_file(self, k, batch=None):
+        """Remove a note from the database on disc.
+
+        @param batch: AtomicWriteBatch to remove the note with, or None to
+        remove it right away.
+        """
+
+        if self.config.db_wal:
+            self.helper_wal_save(k, None, batch)
+
+        else:
+            fn = self.helper_key_to_fname(k)
+            if os.path.isfile(fn):
+                self.helper_invalidate_snapshot()
+                if batch is None:
+                    os.unlink(fn)
+
+                else:
+                    batch.remove(fn)
+
+    def helper_invalidate_snapshot(self):
+        """Remove the snapshot as soon as any .json file changes.
+
+        The .json files are always written, so once the snapshot is out of
+        date we simply fall back to them on the next startup.
+        """
+
+        if self.snapshot_valid:
+            self.snapshot_valid = False
+            try:
+                os.unlink(self.helper_snapshot_fname())
+
+            except OSError:
+                # another thread could have beaten us to it.
+                pass
+    
+    def helper_save_title_file(self, k):
+        # the save worker can't use our caches, so we look up the text
+        # filename for it.
+        if self.config.notes_as_txt:
+            return self.get_note_title_file(k)
+
+        return None
+
+    def helper_save_note(self, k, note, batch, txt_written, title_file):
+        """Save a single note to disc.
+
+        Every file is replaced atomically, but only flushed to disc once
+        batch is committed.
+
+        @param batch: AtomicWriteBatch to write the note with.
+        @param txt_written: dictionary that receives text filename to sha1
+        of the text files written, for self.txt_written once batch is
+        committed.
+        @param title_file: name of the note's text file, see
+        get_note_title_file().
+        """
+
+        if self.config.notes_as_txt:
+            t = title_file
+            if t and not note.get('deleted'):
+                old_t = self.titlelist.get_name(k)
+                if old_t is not None:
+                    logging.debug('Writing note : %s %s' % (t, old_t))
+                    if old_t != t:
+                        dfn = os.path.join(self.config.txt_path, old_t)
+                        with self.titlelist.lock:
+                            self.txt_written.pop(old_t, None)
+                        if os.path.isfile(dfn):
+                            logging.debug('Delete file %s ' % (dfn, ))
+                            batch.remove(dfn)
+                        else:
+                            logging.debug('File not exits %s ' % (dfn, ))
+                else:
+                    logging.debug('Key not in list %s ' % (k, ))
+
+                self.titlelist.set_name(k, t)
+                fn = os.path.join(self.config.txt_path, t)
+                try:
+                    c = note.get('content')
+                    if isinstance(c, str):
+                        c = unicode(c, 'utf-8')
+                    else:
+                        c = unicode(c)
+
+                    data = c.encode('utf-8')
+                    batch.write(fn, data)
+                    # so that the watcher knows this change is ours.
+                    txt_written[t] = hashlib.sha1(data).digest()
+
+                except (IOError, OSError), e:
+                    logging.error('NotesDB_save: Error opening %s: %s' % (fn, str(e)))
+                    raise WriteError ('Error opening note file')
+
+                except ValueError, e:
+                    logging.error('NotesDB_save: Error writing %s: %s' % (fn, str(e)))
+                    raise WriteError ('Error writing note file')
+
+            elif t and note.get('deleted') and k in self.titlelist:
+                old_t = self.titlelist.get_name(k)
+                dfn = os.path.join(self.config.txt_path, old_t)
+                with self.titlelist.lock:
+                    self.txt_written.pop(old_t, None)
+                if os.path.isfile(dfn):
+                    logging.debug('Delete file %s ' % (dfn, ))
+                    batch.remove(dfn)
+        
+        if not self.config.simplenote_sync and note.get('deleted'):
+            self.helper_delete_note_file(k, batch)
+
+        elif self.config.db_wal:
+            # only log what changed, the .json file is written when the log
+            # is compacted.
+            self.helper_wal_save(k, note, batch)
+
+        else:
+            self.helper_invalidate_snapshot()
+            fn = self.helper_key_to_fname(k)
+            try:
+                batch.write(fn, self.helper_encode_note(note))
+
+            except (IOError, OSError), e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (fn, str(e)))
+                raise WriteError ('Error writing note file')
+
+        # record that we saved this to disc.
+        note['savedate'] = time.time()
+        
+    def sync_note_unthreaded(self, k):
+        """Sync a single note with the server.
+
+        Update existing note in memory with the returned data.  
+        This is a sychronous (blocking) call.
+        """
+
+        note = self.helper_resident_note(k)
+        
+        if not note.get('key') or float(note.get('modifydate')) > float(note.get('syncdate')):
+            # if has no key, or it has been modified sync last sync, 
+            # update to server
+            uret = self.simplenote.update_note(note)
+
+            if uret[1] == 0:
                 # success!
                 n = uret[0]
         
@@ -521,6 +1809,7 @@ class NotesDB(utils.SubjectMixin):
                 
                 # update our existing note in-place!
                 note.update(n)
+                self.helper_note_changed(k)
         
                 # return the key
                 return (k, new_content)
@@ -539,6 +1828,7 @@ class NotesDB(utils.SubjectMixin):
                 if int(n.get('syncnum')) > int(note.get('syncnum')):
                     n['syncdate'] = time.time()
                     note.update(n)
+                    self.helper_note_changed(k)
                     return (k, True)
                 
                 else:
@@ -548,14 +1838,55 @@ class NotesDB(utils.SubjectMixin):
                 return None
 
         
+    def flush_saves(self, timeout=None):
+        """Write all unsaved notes now, without waiting for save_interval.
+
+        @param timeout: wait at most this many seconds, None for no limit.
+        @returns: True if everything was saved.
+        """
+
+        self.save_threaded()
+        flushed = self.q_save.flush(timeout)
+        self.save_threaded()
+
+        return flushed
+
+    def close(self):
+        """Release the text note watcher and the search index database.
+
+        The notes can't be searched or watched anymore afterwards, so
+        this is the last thing to call before exiting.
+        """
+
+        if self.txt_watcher is not None:
+            self.txt_watcher.close()
+            self.txt_watcher = None
+
+        if self.search_db is not None:
+            try:
+                self.search_db.close()
+
+            except notes_store.SearchIndexError, e:
+                logging.error('NotesDB: Error closing search index: %s' % (str(e),))
+
+            self.search_db = None
+
     def save_threaded(self):
-        for k,n in self.notes.items():
+        # only notes that changed since our previous call can need saving
+        # the save worker coalesces repeated saves of the same note, see
+        # SaveScheduler.
+        for k in self.get_changed_keys('save'):
+            n = self.notes.get(k)
+            if n is None:
+                continue
+
             savedate = float(n.get('savedate'))
             if float(n.get('modifydate')) > savedate or \
                float(n.get('syncdate')) > savedate:
-                cn = copy.deepcopy(n)
+                cn = self.helper_copy_note(self.helper_resident_note(k))
                 # put it on my queue as a save
-                o = utils.KeyValueObject(action=ACTION_SAVE, key=k, note=cn)
+                o = utils.KeyValueObject(action=ACTION_SAVE, key=k, note=cn,
+                                         title_file=self.helper_save_title_file(k))
                 self.q_save.put(o)
                 
         # in this same call, we process stuff that might have been put on the result queue
@@ -574,7 +1905,10 @@ class NotesDB(utils.SubjectMixin):
                 self.notes[o.key]['savedate'] = o.note['savedate']
                 self.notify_observers('change:note-status', utils.KeyValueObject(what='savedate',key=o.key))
                 nsaved += 1
-                
+
+        # notes that have just been saved can leave memory.
+        self.helper_evict_content()
+
         return nsaved
         
     
@@ -599,20 +1933,28 @@ class NotesDB(utils.SubjectMixin):
             lastmod = 0
         
         now = time.time()
-        for k,n in self.notes.items():
+        journal = self.change_journals['sync']
+        for k in list(journal):
+            n = self.notes.get(k)
             # if note has been modified sinc the sync, we need to sync.
+            if n is None or float(n.get('modifydate', -1)) <= float(n.get('syncdate', -1)):
+                journal.discard(k)
+                continue
+
             # only do so if note hasn't been touched for 3 seconds
             # and if this note isn't still in the queue to be processed by the
             # worker (this last one very important)
+            # and if no full sync, which could be sending it too, is running.
+            # otherwise, we keep it in the journal for the next call.
             modifydate = float(n.get('modifydate', -1))
-            syncdate = float(n.get('syncdate', -1))
-            if modifydate > syncdate and \
-               now - modifydate > lastmod and \
-               k not in self.threaded_syncing_keys:
+            if now - modifydate > lastmod and \
+               k not in self.threaded_syncing_keys and \
+               not self.sync_full_running:
+                journal.discard(k)
                 # record that we've requested a sync on this note,
                 # so that we don't keep on putting stuff on the queue.
                 self.threaded_syncing_keys[k] = True
-                cn = copy.deepcopy(n)
+                cn = self.helper_copy_note(self.helper_resident_note(k))
                 # we store the timestamp when this copy was made as the syncdate
                 cn['syncdate'] = time.time()
                 # put it on my queue as a sync
@@ -649,8 +1991,9 @@ class NotesDB(utils.SubjectMixin):
                             # note was synced AFTER the last modification to our local version
                             # do an in-place update of the existing note
                             # this could be with or without new content.
-                            old_note = copy.deepcopy(self.notes[okey])
+                            old_note = self.helper_copy_note(self.helper_resident_note(okey))
                             self.notes[okey].update(o.note)
+                            self.helper_note_changed(okey)
                             # notify anyone (probably nvPY) that this note has been changed
                             self.notify_observers('synced:note', utils.KeyValueObject(lkey=okey, old_note=old_note))
                             
@@ -667,6 +2010,7 @@ class NotesDB(utils.SubjectMixin):
                             tkeys = ['syncnum', 'version', 'syncdate', 'key']
                             for tk in tkeys:
                                 self.notes[okey][tk] = o.note[tk]
+                            self.helper_note_changed(okey)
                             
                         nsynced += 1
                         self.notify_observers('change:note-status', utils.KeyValueObject(what='syncdate',key=okey))
@@ -674,136 +2018,376 @@ class NotesDB(utils.SubjectMixin):
                 # after having handled the note that just came back,
                 # we can take it from this blocker dict
                 del self.threaded_syncing_keys[okey]
+                # and check next time if it still has to be synced, e.g.
+                # after an error.
+                self.change_journals['sync'].add(okey)
 
         return (nsynced, nerrored)
     
     
     def sync_full(self):
-        """Perform a full bi-directional sync with server.
+        """Perform a full bi-directional sync with server, and wait for it.
+
+        See sync_full_threaded() and sync_full_apply(), which this calls on
+        the current thread.
+
+        @returns: number of notes that could not be fetched from the server.
+        @raises SyncError: if the sync failed.
+        """
+
+        self.sync_full_threaded()
+        while True:
+            res = self.sync_full_apply(block=True)
+            if res.error is not None:
+                raise res.error
+
+            if res.done:
+                return res.errors
+
+    def sync_full_threaded(self):
+        """Start a full bi-directional sync with server in the background.
         
         This follows the recipe in the SimpleNote 2.0 API documentation.
-        After this, it could be that local keys have been changed, so
-        reset any views that you might have.
+        All network traffic happens on a background thread. The main
+        thread has to apply its results to self.notes by calling
+        sync_full_apply() until that reports the sync is done. The user
+        can keep on working in the meantime.
+
+        If a previous sync left a cursor, we only ask the server for the
+        notes that changed since SYNC_CURSOR_MARGIN before then, and skip
+        step 3. Every FULL_INDEX_INTERVAL, or when that fails, we get the
+        full index.
+        The syncnum of each note, persisted in the note itself, still
+        decides if we have to fetch it.
+
+        @returns: False if a full sync is already running, else True.
         """
-        
-        local_updates = {}
-        local_deletes = {}
-        now = time.time()
+
+        if self.sync_full_running:
+            return False
+
+        self.sync_full_running = True
+        self.sync_full_start = time.time()
+        self.sync_full_errors = 0
+        self.sync_full_count = 0
+        self.q_sync_full_res = Queue()
 
         self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Starting full sync.'))
         # 1. go through local notes, if anything changed or new, update to server
-        for ni,lk in enumerate(self.notes.keys()):
-            n = self.notes[lk]
-            if not n.get('key') or float(n.get('modifydate')) > float(n.get('syncdate')):
-                uret = self.simplenote.update_note(n)
-                if uret[1] == 0:
-                    # replace n with uret[0]
-                    # if this was a new note, our local key is not valid anymore
-                    del self.notes[lk]
-                    # in either case (new or existing note), save note at assigned key
-                    k = uret[0].get('key')
-                    # we merge the note we got back (content coud be empty!)
-                    n.update(uret[0])
-                    # and put it at the new key slot
-                    self.notes[k] = n
-                    
-                    # record that we just synced
-                    uret[0]['syncdate'] = now
-                    
-                    # whatever the case may be, k is now updated
-                    local_updates[k] = True
-                    if lk != k:
-                        # if lk was a different (purely local) key, should be deleted
-                        local_deletes[lk] = True
-                        
-                    self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced modified note %d to server.' % (ni,)))
-                        
-                else:
-                    raise SyncError("Sync step 1 error - Could not update note to server")
-             
-        # 2. if remote syncnum > local syncnum, update our note; if key is new, add note to local.
-        # this gets the FULL note list, even if multiple gets are required
-        self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Retrieving full note list from server, could take a while.'))       
-        nl = self.simplenote.get_note_list()
-        if nl[1] == 0:
-            nl = nl[0]
-            self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Retrieved full note list from server.'))
-            
+        # we send copies, so the user can keep on editing. notes that are
+        # still on their way to the server with a partial sync are left to
+        # that.
+        to_upload = []
+        for lk, n in self.notes.items():
+            if (not n.get('key') or float(n.get('modifydate')) > float(n.get('syncdate'))) and \
+               lk not in self.threaded_syncing_keys:
+                to_upload.append((lk, self.helper_copy_note(self.helper_resident_note(lk))))
+
+        # for step 2
+        local_syncnums = dict([(k, int(n.get('syncnum', -1))) for k, n in self.notes.items()])
+        cursor = self.sync_state.get('cursor')
+        if cursor is not None:
+            cursor = float(cursor) - self.SYNC_CURSOR_MARGIN
+
+        incremental = cursor is not None and len(self.notes) > 0 and \
+                      self.sync_full_start - self.sync_state.get('full_index_date', 0) < self.FULL_INDEX_INTERVAL
+
+        thread_sync_full = Thread(target=self.worker_sync_full,
+                                  args=(to_upload, local_syncnums, cursor, incremental))
+        thread_sync_full.setDaemon(True)
+        thread_sync_full.start()
+
+        return True
+
+    def sync_full_apply(self, max_results=None, block=False):
+        """Apply results of the background full sync to self.notes.
+
+        Call this from the main thread only.
+
+        @param max_results: apply at most this many results, so that the
+        caller stays responsive. None for all results that are available.
+        @param block: wait until there is at least one result.
+        @returns: KeyValueObject with changed, True if notes were changed;
+        rekeyed, dictionary mapping old to new local key of notes that got
+        their server key; done, True if the sync is complete; errors, the
+        number of notes that could not be fetched from the server; and
+        error, the SyncError if the sync failed, else None. A failed sync
+        is done, but changed and rekeyed still have to be applied.
+        """
+
+        res = utils.KeyValueObject(changed=False, rekeyed={}, done=False,
+                                   errors=self.sync_full_errors, error=None)
+
+        napplied = 0
+        while max_results is None or napplied < max_results:
+            try:
+                r = self.q_sync_full_res.get(block and napplied == 0)
+
+            except Empty:
+                break
+
+            napplied += 1
+            action = r[0]
+
+            if action == 'progress':
+                self.notify_observers('progress:sync_full', utils.KeyValueObject(msg=r[1]))
+
+            elif action == 'uploaded':
+                self.helper_sync_full_uploaded(r[1], r[2], r[3], res)
+
+            elif action == 'fetched':
+                self.helper_sync_full_fetched(r[1], r[2], res)
+
+            elif action == 'error':
+                self.sync_full_running = False
+                res.error = r[1]
+                res.done = True
+                break
+
+            elif action == 'done':
+                self.helper_sync_full_done(r[1], r[2], res)
+                break
+
+        return res
+
+    def helper_sync_full_uploaded(self, lk, cn, un, res):
+        """Merge the reply to a step 1 upload of note lk.
+
+        @param cn: the copy of the note that we sent.
+        @param un: the note as returned by the server.
+        """
+
+        n = self.notes.get(lk)
+        if n is None:
+            return
+
+        # in either case (new or existing note), save note at assigned key
+        k = un.get('key')
+        if float(n.get('modifydate')) > float(cn.get('modifydate')):
+            # the user has changed stuff since the version that got synced
+            # just record syncnum, version and key, the next partial sync
+            # sends the rest. see sync_to_server_threaded().
+            for tk in ['syncnum', 'version', 'key']:
+                n[tk] = un[tk]
+
         else:
-            raise SyncError('Could not get note list from server.')
-        
-        server_keys = {}
-        lennl = len(nl)
-        sync_from_server_errors = 0
-        for ni,n in enumerate(nl):
-            k = n.get('key')
-            server_keys[k] = True
-            # this works, only because in phase 1 we rewrite local keys to
-            # server keys when we get an updated not back from the server
-            if k in self.notes:
-                # we already have this
-                # check if server n has a newer syncnum than mine
-                if int(n.get('syncnum')) > int(self.notes[k].get('syncnum', -1)):
-                    # and the server is newer
-                    ret = self.simplenote.get_note(k)
-                    if ret[1] == 0:
-                        self.notes[k].update(ret[0])
-                        local_updates[k] = True
-                        # in both cases, new or newer note, syncdate is now.
-                        self.notes[k]['syncdate'] = now
-                        self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced newer note %d (%d) from server.' % (ni,lennl)))
+            # we merge the note we got back (content coud be empty!)
+            n.update(un)
+            # record that we just synced
+            n['syncdate'] = time.time()
+
+        if lk != k:
+            # if this was a new note, our local key is not valid anymore
+            # and has to be deleted. we put it at the new key slot, and save
+            # it there straight away.
+            n = self.helper_resident_note(lk)
+            del self.notes[lk]
+            self.notes[k] = n
+            if self.config.notes_as_txt:
+                # the text file now belongs to the new key
+                t = self.titlelist.get_name(lk)
+                self.titlelist.remove(lk)
+                if t is not None:
+                    self.titlelist.set_name(k, t)
+            self.helper_note_changed(lk)
+            self.helper_delete_note_file(lk)
+            self.q_save.put(utils.KeyValueObject(action=ACTION_SAVE, key=k, note=self.helper_copy_note(n),
+                                                 title_file=self.helper_save_title_file(k)))
+            res.rekeyed[lk] = k
+
+        self.helper_note_changed(k)
+        res.changed = True
+
+        self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced modified note %d to server.' % (self.sync_full_count,)))
+        self.sync_full_count += 1
+
+    def helper_sync_full_fetched(self, k, ret, res):
+        """Merge step 2 fetch result ret for note k.
+        """
 
-                    else:
-                        logging.error('Error syncing newer note %s from server: %s' % (k, ret[0]))
-                        sync_from_server_errors+=1
+        if ret[1] != 0:
+            logging.error('Error syncing note %s from server: %s' % (k, ret[0]))
+            self.sync_full_errors += 1
+            res.errors = self.sync_full_errors
+            return
 
-            else:
-                # new note
-                ret = self.simplenote.get_note(k)
-                if ret[1] == 0:
-                    self.notes[k] = ret[0]
-                    local_updates[k] = True
-                    # in both cases, new or newer note, syncdate is now.
-                    self.notes[k]['syncdate'] = now
-                    self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced new note %d (%d) from server.' % (ni,lennl)))
+        n = self.notes.get(k)
+        if n is not None:
+            if float(n.get('modifydate', 0)) > self.sync_full_start:
+                # the user changed the note during the sync. the next
+                # partial sync sends it with the old version, so the server
+                # merges both.
+                return
 
-                else:
-                    logging.error('Error syncing new note %s from server: %s' % (k, ret[0]))
-                    sync_from_server_errors+=1
+            # the server is newer
+            n.update(ret[0])
+            msg = 'Synced newer note %d from server.'
+
+        else:
+            # new note, which still has to be saved
+            n = self.notes[k] = ret[0]
+            n['savedate'] = 0
+            msg = 'Synced new note %d from server.'
+
+        # in both cases, new or newer note, syncdate is now. the save
+        # housekeeping picks it up from there.
+        n['syncdate'] = time.time()
+        self.helper_note_changed(k)
+        res.changed = True
+
+        self.notify_observers('progress:sync_full', utils.KeyValueObject(msg=msg % (self.sync_full_count,)))
+        self.sync_full_count += 1
+
+    def helper_sync_full_done(self, index, incremental, res):
+        """Step 3 and wrap-up of the full sync.
+        """
 
         # 3. for each local note not in server index, remove.     
-        for lk in self.notes.keys():
-            if lk not in server_keys:
+        # an incremental index only has the changed notes, so we can't.
+        # notes that don't have a server key yet were created during the
+        # sync, so they stay.
+        for lk in ([] if incremental else self.notes.keys()):
+            if lk not in index.server_keys and self.notes[lk].get('key'):
                 if self.config.notes_as_txt:
-                    tfn = os.path.join(self.config.txt_path, utils.get_note_title_file(self.notes[lk]))
-                    if os.path.isfile(tfn):
-                        os.unlink(tfn)
+                    # with lazy content, the note itself may not have the
+                    # content its filename comes from.
+                    t = self.titlelist.get_name(lk)
+                    if t is not None:
+                        tfn = os.path.join(self.config.txt_path, t)
+                        if os.path.isfile(tfn):
+                            os.unlink(tfn)
+                        self.titlelist.remove(lk)
                 del self.notes[lk]
-                local_deletes[lk] = True
-                
-        # sync done, now write changes to db_path
-        for uk in local_updates.keys():
-            try:
-                self.helper_save_note(uk, self.notes[uk])
+                self.helper_note_changed(lk)
+                self.helper_delete_note_file(lk)
+                res.changed = True
 
-            except WriteError, e:
-                raise WriteError(e)
-            
-        for dk in local_deletes.keys():
-            fn = self.helper_key_to_fname(dk)
-            if os.path.exists(fn):
-                os.unlink(fn)
+        if self.config.db_wal:
+            # we're on the main thread, so worker_wal_compact() does that.
+            self.wal_compact_event.set()
+
+        else:
+            self.checkpoint()
+
+        # we use the server's modifydates for our cursor, so that our clock
+        # does not matter, see SYNC_CURSOR_MARGIN for what that misses. if
+        # some notes could not be fetched, we keep the old cursor, so that
+        # we try again next time.
+        if not self.sync_full_errors:
+            mds = [md for md in (self.sync_state.get('cursor'), index.modifydate) if md is not None]
+            if mds:
+                self.sync_state['cursor'] = max([float(md) for md in mds])
+
+            if not incremental:
+                self.sync_state['full_index_date'] = self.sync_full_start
+
+            self.helper_save_sync_state()
+
+        self.sync_full_running = False
+        res.done = True
+        res.errors = self.sync_full_errors
 
         self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Full sync complete.'))
 
-        return sync_from_server_errors
-        
+    def worker_sync_full(self, to_upload, local_syncnums, cursor, incremental):
+        """Network side of sync_full_threaded(), on its own thread.
+
+        Everything is reported to the main thread as tuples on
+        q_sync_full_res: ('progress', msg), ('uploaded', local key, sent
+        copy, returned note), ('fetched', key, get_note result),
+        ('error', SyncError) and finally ('done', index, incremental).
+        """
+
+        q = self.q_sync_full_res
+        try:
+            # the uploads run concurrently
+            uploads = utils.imap_threaded(lambda item: self.simplenote.update_note(item[1]),
+                                          to_upload, self.config.sync_threads)
+            for (lk, cn), uret in uploads:
+                if uret[1] != 0:
+                    raise SyncError("Sync step 1 error - Could not update note to server")
+
+                local_syncnums.pop(lk, None)
+                local_syncnums[uret[0].get('key')] = int(uret[0].get('syncnum', -1))
+                q.put(('uploaded', lk, cn, uret[0]))
+
+            # 2. if remote syncnum > local syncnum, update our note; if key is new, add note to local.
+            if incremental:
+                q.put(('progress', 'Retrieving notes changed on server since last sync.'))
+                try:
+                    index = self.helper_sync_from_server(cursor, local_syncnums)
+
+                except IOError, e:
+                    logging.error('Could not get changed notes from server, getting full note list instead: %s' % (str(e),))
+                    incremental = False
+
+            if not incremental:
+                # this gets the FULL note list, even if multiple gets are required
+                q.put(('progress', 'Retrieving full note list from server, could take a while.'))
+                try:
+                    index = self.helper_sync_from_server(None, local_syncnums)
+
+                except IOError, e:
+                    logging.error('Could not get note list from server: %s' % (str(e),))
+                    raise SyncError('Could not get note list from server.')
+
+        except SyncError, e:
+            q.put(('error', e))
+
+        except Exception, e:
+            logging.exception('Full sync failed')
+            q.put(('error', SyncError('Full sync failed: %s' % (str(e),))))
+
+        else:
+            q.put(('done', index, incremental))
+
+    def helper_sync_from_server(self, since, local_syncnums):
+        """Step 2 of the full sync: get all notes that are newer on the
+        server, on the full sync's background thread.
+
+        The index is streamed page by page, and the notes it lists are
+        fetched concurrently while later pages are still arriving. Each
+        fetched note is passed on to the main thread.
+
+        @param since: only look at notes changed after this server
+        modifydate, or None for the full index.
+        @param local_syncnums: dictionary mapping key to syncnum of our
+        notes.
+        @returns: KeyValueObject with server_keys, the keys in the index;
+        and modifydate, the latest modifydate in the index or None.
+        @raises IOError: if the index could not be retrieved.
+        """
+
+        index = utils.KeyValueObject(server_keys={}, modifydate=None)
+
+        def to_fetch():
+            for n in self.simplenote.iter_note_list(since=since):
+                k = n.get('key')
+                index.server_keys[k] = True
+                md = float(n.get('modifydate', 0))
+                if index.modifydate is None or md > index.modifydate:
+                    index.modifydate = md
+
+                # this works, only because in phase 1 we rewrite local keys to
+                # server keys when we get an updated not back from the server
+                # if we already have this, check if server n has a newer
+                # syncnum than mine
+                if k not in local_syncnums or int(n.get('syncnum')) > local_syncnums[k]:
+                    yield k
+
+        fetches = utils.imap_threaded(self.simplenote.get_note, to_fetch(), self.config.sync_threads)
+        for k, ret in fetches:
+            self.q_sync_full_res.put(('fetched', k, ret))
+
+        return index
+
     def set_note_content(self, key, content):
-        n = self.notes[key]
+        n = self.helper_resident_note(key)
         old_content = n.get('content')
         if content != old_content:
             n['content'] = content
             n['modifydate'] = time.time()
+            self.helper_note_changed(key)
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
     def set_note_tags(self, key, tags):
@@ -813,49 +2397,114 @@ class NotesDB(utils.SubjectMixin):
         if tags != old_tags:
             n['tags'] = tags
             n['modifydate'] = time.time()
+            self.helper_note_changed(key, content_changed=False)
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
     def set_note_pinned(self, key, pinned):
         n = self.notes[key]
         old_pinned = utils.note_pinned(n)
         if pinned != old_pinned:
-            if 'systemtags' not in n:
-                n['systemtags'] = []
-
-            systemtags = n['systemtags']
+            # we replace the list instead of changing it, see
+            # helper_copy_note()
+            systemtags = [t for t in n.get('systemtags', []) if t != 'pinned']
 
             if pinned:
                 # which by definition means that it was NOT pinned
                 systemtags.append('pinned')
 
-            else:
-                systemtags.remove('pinned')
+            n['systemtags'] = systemtags
 
             n['modifydate'] = time.time()
+            self.helper_note_changed(key, content_changed=False)
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
 
+    def checkpoint(self):
+        """Consolidate the database on disc for a fast next startup.
+
+        In wal mode, this compacts the write-ahead log into the .json files
+        and the snapshot. Otherwise, the snapshot is rewritten, but only
+        when every note in memory has also been saved to its .json file, so
+        that the .json files remain a valid fallback.
+
+        @return: True if the database was consolidated, False otherwise.
+        """
+
+        if self.config.db_wal:
+            try:
+                self.helper_wal_compact()
+
+            except WriteError, e:
+                # the write-ahead log still has everything, so the next
+                # startup replays it and compacts again.
+                logging.error('NotesDB_checkpoint: Error compacting write-ahead log: %s' % (str(e),))
+                return False
+
+            return True
+
+        if not self.config.db_snapshot or self.q_save.qsize() > 0:
+            return False
+
+        for n in self.notes.values():
+            savedate = float(n.get('savedate'))
+            if float(n.get('modifydate')) > savedate or \
+               float(n.get('syncdate')) > savedate:
+                return False
+
+        fn = self.helper_snapshot_fname()
+        try:
+            batch = notes_store.AtomicWriteBatch(self.durability)
+            notes_store.write_snapshot(fn, self.notes, batch,
+                                       self.config.db_compress_size)
+            batch.commit()
+
+        except (IOError, OSError), e:
+            logging.error('NotesDB_snapshot: Error writing %s: %s' % (fn, str(e)))
+            return False
+
+        self.snapshot_valid = True
+        return True
+
     def worker_save(self):
         while True:
-            o = self.q_save.get()
+            saves = self.q_save.get_batch(SAVE_BATCH_SIZE)
+            batch = notes_store.AtomicWriteBatch(self.durability)
+            txt_written = {}
+
+            try:
+                for o in saves:
+                    if o.action == ACTION_SAVE:
+                        # this will write the savedate into o.note
+                        # with filename o.key.json
+                        self.helper_save_note(o.key, o.note, batch, txt_written, o.title_file)
 
-            if o.action == ACTION_SAVE:
-                # this will write the savedate into o.note
-                # with filename o.key.json
                 try:
-                    self.helper_save_note(o.key, o.note)
+                    batch.commit()
 
-                except WriteError, e:
-                    logging.error('FATAL ERROR in access to file system')
-                    print "FATAL ERROR: Check the nvpy.log"
-                    os._exit(1) 
+                except (IOError, OSError), e:
+                    logging.error('NotesDB_save: Error flushing %s: %s' % (self.db_path, str(e)))
+                    raise WriteError ('Error flushing note files')
 
-                else:
-                    # put the whole thing back into the result q
-                    # now we don't have to copy, because this thread
-                    # is never going to use o again.
-                    # somebody has to read out the queue...
+                if txt_written:
+                    # the watcher may only ignore what really is on disc.
+                    with self.titlelist.lock:
+                        self.txt_written.update(txt_written)
+
+            except WriteError, e:
+                logging.error('FATAL ERROR in access to file system')
+                print "FATAL ERROR: Check the nvpy.log"
+                os._exit(1) 
+
+            else:
+                # put the whole thing back into the result q
+                # now we don't have to copy, because this thread
+                # is never going to use o again.
+                # somebody has to read out the queue...
+                for o in saves:
                     self.q_save_res.put(o)
+
+            finally:
+                self.q_save.task_done([o.key for o in saves])
                 
     def worker_sync(self):
         while True:
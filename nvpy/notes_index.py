@@ -0,0 +1,567 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+# search indexes maintained by NotesDB. they are kept in memory, except with
+# lazy content, when the postings are in a notes_store.PostingsStore.
+
+import bisect
+import re
+import sre_constants
+import sre_parse
+from threading import Lock
+import unicodedata
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+def to_unicode(s):
+    if isinstance(s, str):
+        return unicode(s, 'utf-8', 'replace')
+
+    return s
+
+def normalize(s, fold=False):
+    """Normalize s for case insensitive searching.
+
+    @param s: string to normalize.
+    @param fold: if True, also strip accents, so that e.g. cafe matches cafe
+    with an accented e.
+    @returns: lowercased unicode string.
+    """
+
+    s = to_unicode(s).lower()
+    if fold:
+        s = u''.join([c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c)])
+
+    return s
+
+class PostingsIndex:
+    """Map tokens to the set of local keys of the notes containing them.
+
+    Notes are not indexed when they change, but only marked with
+    invalidate(). The next refresh() then reindexes only those notes.
+
+    @ivar postings: dictionary mapping token to set of local keys.
+    @ivar note_tokens: dictionary mapping local key to frozenset of tokens.
+    @ivar dirty: set of local keys that have to be reindexed.
+    @ivar fold: strip accents when normalizing, see normalize().
+    """
+
+    def __init__(self, fold=False):
+        self.postings = {}
+        self.note_tokens = {}
+        self.dirty = set()
+        self.fold = fold
+
+    def tokenize(self, note, content):
+        """Return iterable of tokens for note. Override in subclass.
+
+        @param content: the note's content, already normalized.
+        """
+        raise NotImplementedError
+
+    def invalidate(self, k):
+        self.dirty.add(k)
+
+    def refresh(self, notes, normalized_content):
+        """Reindex all notes that were invalidated since the last refresh.
+
+        Deleted notes are dropped from the index.
+
+        @param notes: dictionary mapping local key to note.
+        @param normalized_content: callable returning the normalized content
+        of the note with the given local key.
+        """
+
+        for k in self.dirty:
+            n = notes.get(k)
+            if n is None or n.get('deleted'):
+                self.update(k, ())
+                self.note_tokens.pop(k, None)
+
+            else:
+                self.update(k, self.tokenize(n, normalized_content(k)))
+
+        self.dirty = set()
+
+    def update(self, k, tokens):
+        old = self.note_tokens.get(k, frozenset())
+        tokens = frozenset(tokens)
+
+        for t in old - tokens:
+            keys = self.postings[t]
+            keys.discard(k)
+            if not keys:
+                del self.postings[t]
+
+        new_tokens = tokens - old
+        for t in new_tokens:
+            keys = self.postings.get(t)
+            if keys is None:
+                self.postings[t] = set([k])
+                self.new_token(t)
+
+            else:
+                keys.add(k)
+
+        self.note_tokens[k] = tokens
+
+    def new_token(self, t):
+        """Called when token t is added to the index for the first time.
+        """
+        pass
+
+    def get_keys(self, t):
+        """Return set of local keys of the notes with token t.
+        """
+        return self.postings.get(t, set())
+
+class WordIndex(PostingsIndex):
+    """Inverted index from lowercased words to notes.
+
+    Search patterns can match anywhere inside words, so each word of a
+    pattern is looked up in the vocabulary with a substring test. These
+    lookups are remembered, and kept up to date as words are added.
+
+    @ivar vocab_matches: dictionary mapping pattern word to set of indexed
+    words that contain it.
+    """
+
+    # we forget remembered lookups when there are more than this.
+    MAX_VOCAB_MATCHES = 64
+
+    def __init__(self, fold=False):
+        PostingsIndex.__init__(self, fold)
+        self.vocab_matches = {}
+
+    def tokenize(self, note, content):
+        return word_re.findall(content)
+
+    def new_token(self, t):
+        for pw, words in self.vocab_matches.items():
+            if pw in t:
+                words.add(t)
+
+    def helper_vocab_matches(self, pw):
+        words = self.vocab_matches.get(pw)
+        if words is not None:
+            return words
+
+        # if we've already looked up a part of pw, only the words that were
+        # found then can contain pw.
+        vocab = self.postings
+        for opw, owords in self.vocab_matches.items():
+            if opw in pw and len(owords) < len(vocab):
+                vocab = owords
+
+        words = set([w for w in vocab if pw in w and w in self.postings])
+
+        if len(self.vocab_matches) >= self.MAX_VOCAB_MATCHES:
+            self.vocab_matches.clear()
+
+        self.vocab_matches[pw] = words
+        return words
+
+    def get_keys_containing(self, pw):
+        """Return set of local keys of the notes with a word that contains
+        pw.
+        """
+
+        keys = set()
+        for w in self.helper_vocab_matches(pw):
+            keys.update(self.postings.get(w, ()))
+
+        return keys
+
+    def candidates(self, patterns):
+        """Find notes that could contain all patterns as substrings.
+
+        This is a superset of the notes that actually contain them, as
+        patterns are only matched word by word and without case. The caller
+        still has to check each candidate.
+
+        @param patterns: list of search strings.
+        @returns: set of local keys, or None if the patterns have no words
+        and hence every note is a candidate.
+        """
+
+        result = None
+        for p in patterns:
+            for pw in word_re.findall(normalize(p, self.fold)):
+                keys = self.get_keys_containing(pw)
+
+                if result is None:
+                    result = keys
+                else:
+                    result &= keys
+
+                if not result:
+                    return result
+
+        return result
+
+class TrigramIndex(PostingsIndex):
+    """Index from lowercased trigrams of note content and tags to notes.
+
+    Used with regexp_trigram_query() to find the notes a regular expression
+    could possibly match.
+    """
+
+    def tokenize(self, note, content):
+        t = content
+        tags = note.get('tags')
+        if tags:
+            t = t + u'\n' + normalize(u'\n'.join([to_unicode(tag) for tag in tags]), self.fold)
+
+        return set([t[i:i+3] for i in xrange(len(t) - 2)])
+
+    def candidates(self, query):
+        """Find notes that satisfy query.
+
+        @param query: as returned by regexp_trigram_query()
+        @returns: set of local keys, or None if every note is a candidate.
+        """
+
+        if query is None:
+            return None
+
+        elif isinstance(query, basestring):
+            return self.get_keys(query)
+
+        op, subqueries = query
+        result = None
+        for sq in subqueries:
+            keys = self.candidates(sq)
+            if keys is None:
+                if op == 'or':
+                    # one alternative matches everything, so the whole does.
+                    return None
+
+            elif result is None:
+                result = set(keys)
+
+            elif op == 'and':
+                result &= keys
+
+            else:
+                result |= keys
+
+        return result
+
+def note_stamp(note):
+    """Return a string that changes whenever the content or tags of note
+    do, without looking at the content.
+
+    Local changes always set a new modifydate, and changes from the server
+    come with a new syncnum.
+    """
+
+    return '%r %r' % (float(note.get('modifydate', 0)), note.get('syncnum'))
+
+class StoredPostingsMixin:
+    """Keeps the postings of a PostingsIndex subclass in a
+    notes_store.PostingsStore on disc instead of in memory.
+
+    Each note is stored with the note_stamp() it was indexed at, so that
+    notes that did not change since, also not in an earlier session, are
+    not read and tokenized again.
+
+    @ivar store: notes_store.PostingsStore with the postings.
+    @ivar stamps: dictionary mapping local key to the stamp of each
+    indexed note, read from the store by the first refresh().
+    """
+
+    def __init__(self, store, fold=False):
+        self.store = store
+        self.stamps = None
+        self.dirty = set()
+        self.fold = fold
+
+    def refresh(self, notes, normalized_content):
+        """Reindex all notes that were invalidated and changed since they
+        were last indexed, see PostingsIndex.refresh().
+
+        @raises notes_store.SearchIndexError: if the store failed. Nothing
+        was changed then.
+        """
+
+        try:
+            if self.stamps is None:
+                self.stamps = self.store.get_stamps()
+                # notes removed while we were not running
+                for k in [k for k in self.stamps if k not in notes]:
+                    self.store.update(k, (), None)
+                    del self.stamps[k]
+
+            for k in self.dirty:
+                n = notes.get(k)
+                if n is None or n.get('deleted'):
+                    if k in self.stamps:
+                        self.store.update(k, (), None)
+                        del self.stamps[k]
+
+                    continue
+
+                # the tokens also depend on fold
+                stamp = '%s %d' % (note_stamp(n), self.fold)
+                if self.stamps.get(k) != stamp:
+                    self.store.update(k, self.tokenize(n, normalized_content(k)), stamp)
+                    self.stamps[k] = stamp
+
+            self.store.commit()
+
+        except Exception:
+            # start over from what is in the store
+            self.store.rollback()
+            self.stamps = None
+            raise
+
+        self.dirty = set()
+
+    def get_keys(self, t):
+        return self.store.get_keys(t)
+
+    def get_keys_containing(self, pw):
+        return self.store.get_keys_containing(pw)
+
+class StoredWordIndex(StoredPostingsMixin, WordIndex):
+    """WordIndex with its postings on disc.
+    """
+    pass
+
+class StoredTrigramIndex(StoredPostingsMixin, TrigramIndex):
+    """TrigramIndex with its postings on disc.
+    """
+    pass
+
+class SortedView:
+    """All non-deleted notes, kept in the order of their sort keys.
+
+    Like the postings indexes, changed notes are only marked with
+    invalidate() and moved to their new place by the next refresh().
+
+    @ivar sort_key: callable taking local key and note, returning the key
+    that note is sorted on.
+    @ivar entries: sorted list of (sort key, local key) tuples.
+    @ivar note_keys: dictionary mapping local key to its current sort key.
+    @ivar dirty: set of local keys that have to be moved, or None if the
+    whole view has to be rebuilt.
+    """
+
+    def __init__(self, sort_key):
+        self.sort_key = sort_key
+        self.entries = []
+        self.note_keys = {}
+        self.dirty = None
+
+    def invalidate(self, k):
+        if self.dirty is not None:
+            self.dirty.add(k)
+
+    def refresh(self, notes):
+        """Move all invalidated notes to their place in the view.
+
+        @param notes: dictionary mapping local key to note.
+        """
+
+        # when many notes changed, sorting them all in one go is cheaper
+        # than inserting them one by one.
+        if self.dirty is None or len(self.dirty) > len(self.entries) // 8 + 16:
+            self.note_keys = {}
+            for k, n in notes.items():
+                if not n.get('deleted'):
+                    self.note_keys[k] = self.sort_key(k, n)
+
+            self.entries = sorted([(sk, k) for k, sk in self.note_keys.items()])
+
+        else:
+            for k in self.dirty:
+                sk = self.note_keys.pop(k, None)
+                if sk is not None:
+                    i = bisect.bisect_left(self.entries, (sk, k))
+                    del self.entries[i]
+
+                n = notes.get(k)
+                if n is not None and not n.get('deleted'):
+                    sk = self.note_keys[k] = self.sort_key(k, n)
+                    bisect.insort(self.entries, (sk, k))
+
+        self.dirty = set()
+
+    def order(self, keys):
+        """Return keys in the order of this view.
+
+        @param keys: set or dictionary of local keys, all of which have to be
+        in the view.
+        @returns: list of local keys.
+        """
+
+        # few keys: sorting them on their precomputed sort keys is cheaper
+        # than walking the whole view.
+        if len(keys) * 8 < len(self.entries):
+            return sorted(keys, key=lambda k: (self.note_keys[k], k))
+
+        return [k for sk, k in self.entries if k in keys]
+
+class NameIndex:
+    """Two-way map between local keys and names, such as titles or text
+    filenames, that several notes can share.
+
+    It is used from both the main and the save thread, hence the lock.
+
+    @ivar names: dictionary mapping local key to name.
+    @ivar keys: dictionary mapping name to set of local keys.
+    @ivar dirty: set of local keys whose names have to be looked up again
+    by the next refresh().
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.keys = {}
+        self.dirty = set()
+        self.lock = Lock()
+
+    def __contains__(self, k):
+        return k in self.names
+
+    def get_name(self, k):
+        """Return name of note k, or None if it has none.
+        """
+        return self.names.get(k)
+
+    def get_keys(self, name):
+        """Return set of local keys of the notes with name.
+        """
+
+        with self.lock:
+            return set(self.keys.get(name, ()))
+
+    def set_name(self, k, name):
+        with self.lock:
+            self.helper_remove(k)
+            self.names[k] = name
+            self.keys.setdefault(name, set()).add(k)
+
+    def remove(self, k):
+        with self.lock:
+            self.helper_remove(k)
+
+    def helper_remove(self, k):
+        name = self.names.pop(k, None)
+        if name is not None:
+            keys = self.keys[name]
+            keys.discard(k)
+            if not keys:
+                del self.keys[name]
+
+    def invalidate(self, k):
+        self.dirty.add(k)
+
+    def refresh(self, name_of):
+        """Look up the names of all notes that were invalidated since the
+        last refresh.
+
+        @param name_of: callable taking a local key and returning its name,
+        or None if the note should be dropped from the index.
+        """
+
+        for k in self.dirty:
+            name = name_of(k)
+            if name is None:
+                self.remove(k)
+
+            else:
+                self.set_name(k, name)
+
+        self.dirty = set()
+
+def _trigram_and(literal_runs, subqueries, fold):
+    """Combine literal strings and subqueries into a single AND query.
+    """
+
+    q = []
+    for run in literal_runs:
+        run = normalize(run, fold)
+        for i in xrange(len(run) - 2):
+            if run[i:i+3] not in q:
+                q.append(run[i:i+3])
+
+    q.extend([sq for sq in subqueries if sq is not None])
+
+    if not q:
+        return None
+
+    elif len(q) == 1:
+        return q[0]
+
+    else:
+        return ('and', q)
+
+def _trigram_query_seq(subpattern, fold):
+    """Trigram query for a parsed regular expression sequence.
+
+    Consecutive literal characters are collected into runs, each of which
+    requires all of its trigrams. Everything we don't understand breaks a
+    run and places no further requirements.
+    """
+
+    runs = []
+    subqueries = []
+    run = []
+
+    def end_run():
+        if len(run) >= 3:
+            runs.append(u''.join(run))
+        del run[:]
+
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+
+        elif op == sre_constants.AT:
+            # zero-width assertions don't separate the literals around them
+            pass
+
+        elif op == sre_constants.SUBPATTERN:
+            # av is (group, subpattern)
+            end_run()
+            subqueries.append(_trigram_query_seq(av[1], fold))
+
+        elif op == sre_constants.BRANCH:
+            # av is (None, list of alternative subpatterns)
+            end_run()
+            alternatives = [_trigram_query_seq(a, fold) for a in av[1]]
+            if None not in alternatives:
+                subqueries.append(('or', alternatives))
+
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            # av is (min, max, subpattern)
+            end_run()
+            if av[0] >= 1:
+                subqueries.append(_trigram_query_seq(av[2], fold))
+
+        else:
+            end_run()
+
+    end_run()
+
+    return _trigram_and(runs, subqueries, fold)
+
+def regexp_trigram_query(pattern, fold=False):
+    """Derive a trigram query from a regular expression, in the style of
+    Google Code Search.
+
+    Any text the regular expression matches is guaranteed to contain the
+    normalized trigrams required by the query.
+
+    @param pattern: regular expression string.
+    @param fold: normalize with accents stripped, see normalize().
+    @returns: None if the expression requires no trigrams at all, a single
+    trigram string, or a tuple ('and' or 'or', list of subqueries).
+    """
+
+    try:
+        return _trigram_query_seq(sre_parse.parse(to_unicode(pattern)), fold)
+
+    except (sre_constants.error, OverflowError, RuntimeError, ValueError):
+        return None
@@ -0,0 +1,839 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+# on-disk storage formats used by NotesDB, next to the per-note .json files.
+
+import errno
+import json
+import os
+import sqlite3
+import zlib
+
+# durability levels for files written through an AtomicWriteBatch:
+# none: files are replaced atomically, but written out by the OS in its own
+#       time.
+# batch: files are only written to their temporary files at first. when
+#        the batch is committed, their data is flushed in one pass, they
+#        replace their targets, and every directory with renamed or removed
+#        files is flushed once.
+# note: file data and directory are flushed for every single file.
+DURABILITY_NONE = 'none'
+DURABILITY_BATCH = 'batch'
+DURABILITY_NOTE = 'note'
+DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_NOTE)
+
+# fdatasync skips flushing metadata like the access time where available.
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+def fsync_dir(path):
+    """Flush directory path, making renames and removals in it durable.
+    """
+
+    # directories can't be opened on windows.
+    if os.name == 'nt':
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+
+    except OSError:
+        # not every file system supports flushing directories.
+        pass
+
+    finally:
+        os.close(fd)
+
+def write_atomic(fn, data, sync=False):
+    """Replace the contents of fn with data.
+
+    data is first written to a temporary file which then replaces fn, so
+    that a crash halfway through never leaves a truncated file.
+
+    @param fn: filename.
+    @param data: byte string.
+    @param sync: if True, flush data to disc before the rename, so that
+    after a crash fn has either its old or its new contents. The rename
+    itself is only durable once the directory has been flushed as well, see
+    fsync_dir().
+    """
+
+    tfn = _write_temp(fn, data, sync)
+    _replace(tfn, fn)
+
+def _write_temp(fn, data, sync=False):
+    """Write data to the temporary file that is to replace fn, see
+    write_atomic().
+
+    @returns: filename of the temporary file.
+    """
+
+    tfn = fn + '.tmp'
+    f = open(tfn, 'wb')
+    try:
+        f.write(data)
+        if sync:
+            f.flush()
+            _fdatasync(f.fileno())
+
+    finally:
+        f.close()
+
+    return tfn
+
+def _sync_path(fn):
+    """Flush the data of file fn, which has already been closed.
+    """
+
+    fd = os.open(fn, os.O_RDWR)
+    try:
+        _fdatasync(fd)
+
+    finally:
+        os.close(fd)
+
+def _replace(tfn, fn):
+    # on windows, rename does not overwrite existing files
+    if os.name == 'nt' and os.path.exists(fn):
+        os.unlink(fn)
+
+    os.rename(tfn, fn)
+
+# note files and snapshot records are json, unless they start with this magic
+# line, in which case the json that follows is zlib compressed.
+NOTE_ZLIB_MAGIC = 'NVPY-ZLIB 1\n'
+
+def encode_note(note, compact=False, compress_size=0):
+    """Serialize a note for its .json file or snapshot record.
+
+    @param note: note dictionary.
+    @param compact: if True, leave out all indentation and whitespace.
+    @param compress_size: compress notes of which the json is larger than
+    this many bytes, or 0 to never compress.
+    @returns: byte string, to be read back with decode_note().
+    """
+
+    if compact:
+        data = json.dumps(note, separators=(',', ':'))
+
+    else:
+        data = json.dumps(note, indent=2)
+
+    if compress_size and len(data) > compress_size:
+        data = NOTE_ZLIB_MAGIC + zlib.compress(data)
+
+    return data
+
+def decode_note(data):
+    """Read a note written with any of the encode_note() options.
+
+    @param data: byte string.
+    @returns: note dictionary.
+    @raises ValueError: if data is not a valid note.
+    """
+
+    if data.startswith(NOTE_ZLIB_MAGIC):
+        try:
+            data = zlib.decompress(data[len(NOTE_ZLIB_MAGIC):])
+
+        except zlib.error, e:
+            raise ValueError('Invalid compressed note: %s' % (str(e),))
+
+    return json.loads(data)
+
+class AtomicWriteBatch:
+    """Group of file writes and removals that are made durable together.
+
+    Each file is replaced atomically, as with write_atomic(). What is on
+    disc when write() and commit() return depends on the durability level,
+    see DURABILITY_LEVELS. With DURABILITY_BATCH, written and removed
+    files only change when the batch is committed.
+
+    @ivar dirs: set of directories to flush on commit.
+    @ivar files: list of open files to flush on commit.
+    @ivar ops: list of (filename, temporary filename) replacements, and
+    (filename, None) removals, to carry out on commit in this order.
+    """
+
+    def __init__(self, durability=DURABILITY_BATCH):
+        self.durability = durability
+        self.dirs = set()
+        self.files = []
+        self.ops = []
+
+    def write(self, fn, data):
+        if self.durability == DURABILITY_BATCH:
+            # a second write of fn replaces the first one's temporary file.
+            self.ops = [op for op in self.ops if op != (fn, fn + '.tmp')]
+            self.ops.append((fn, _write_temp(fn, data)))
+
+        else:
+            write_atomic(fn, data, self.durability == DURABILITY_NOTE)
+            self.helper_dir_changed(fn)
+
+    def remove(self, fn):
+        if self.durability == DURABILITY_BATCH:
+            self.ops.append((fn, None))
+
+        elif os.path.isfile(fn):
+            os.unlink(fn)
+            self.helper_dir_changed(fn)
+
+    def sync_file(self, f):
+        """Flush f, a file that is appended to instead of replaced.
+        """
+
+        if self.durability == DURABILITY_NOTE:
+            _fdatasync(f.fileno())
+
+        elif self.durability == DURABILITY_BATCH and f not in self.files:
+            self.files.append(f)
+
+    def helper_dir_changed(self, fn):
+        d = os.path.dirname(os.path.abspath(fn))
+        if self.durability == DURABILITY_NOTE:
+            fsync_dir(d)
+
+        elif self.durability == DURABILITY_BATCH:
+            self.dirs.add(d)
+
+    def commit(self):
+        """Flush everything written in this batch to disc.
+        """
+
+        for f in self.files:
+            # a log that was rotated in the meantime has been flushed
+            # already, see WriteAheadLog.rotate().
+            if not f.closed:
+                _fdatasync(f.fileno())
+
+        # the data of all files goes to disc before any of them replaces
+        # its target, so that a crash never leaves a target half-written.
+        for fn, tfn in self.ops:
+            if tfn is not None:
+                _sync_path(tfn)
+
+        for fn, tfn in self.ops:
+            if tfn is not None:
+                _replace(tfn, fn)
+
+            else:
+                try:
+                    os.unlink(fn)
+
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+                    continue
+
+            self.helper_dir_changed(fn)
+
+        for d in self.dirs:
+            fsync_dir(d)
+
+        self.files = []
+        self.dirs = set()
+        self.ops = []
+
+# the snapshot consolidates all notes into a single file:
+# line 1: magic and format version
+# line 2: length in bytes of the header that follows
+# header: json list of [local key, offset, length] triples, with offsets
+#         relative to the first byte after the header.
+# body: notes encoded with encode_note(), one after the other.
+SNAPSHOT_MAGIC = 'NVPY-SNAPSHOT 1'
+
+def write_snapshot(fn, notes, batch=None, compress_size=0):
+    """Write all notes into a single snapshot file.
+
+    The snapshot replaces fn atomically, so that a crash halfway through
+    never leaves a truncated snapshot.
+
+    @param fn: filename of the snapshot.
+    @param notes: dictionary mapping local key to note dictionary.
+    @param batch: AtomicWriteBatch to write the snapshot with, or None to
+    leave flushing it to the OS.
+    @param compress_size: compress records larger than this, see
+    encode_note().
+    """
+
+    records = []
+    index = []
+    offset = 0
+    for k, n in notes.items():
+        r = encode_note(n, True, compress_size)
+        records.append(r)
+        index.append([k, offset, len(r)])
+        offset += len(r)
+
+    header = json.dumps(index)
+    data = ''.join(['%s\n%d\n' % (SNAPSHOT_MAGIC, len(header)), header] + records)
+
+    if batch is None:
+        write_atomic(fn, data)
+
+    else:
+        batch.write(fn, data)
+
+def read_snapshot(fn):
+    """Read all notes from a snapshot file with one sequential read.
+
+    @param fn: filename of the snapshot.
+    @returns: dictionary mapping local key to note dictionary.
+    @raises IOError: if the snapshot could not be read.
+    @raises ValueError: if the snapshot is not valid.
+    """
+
+    f = open(fn, 'rb')
+    try:
+        data = f.read()
+
+    finally:
+        f.close()
+
+    # first two lines: magic and header length
+    magic_end = data.find('\n')
+    if magic_end < 0 or data[:magic_end] != SNAPSHOT_MAGIC:
+        raise ValueError('Not an nvPY snapshot: %s' % (fn,))
+
+    hlen_end = data.find('\n', magic_end + 1)
+    if hlen_end < 0:
+        raise ValueError('Truncated snapshot header: %s' % (fn,))
+
+    hlen = int(data[magic_end + 1:hlen_end])
+    body = hlen_end + 1 + hlen
+    index = json.loads(data[hlen_end + 1:body])
+
+    notes = {}
+    for k, offset, length in index:
+        start = body + offset
+        if start + length > len(data):
+            raise ValueError('Truncated snapshot body: %s' % (fn,))
+
+        notes[k] = decode_note(data[start:start + length])
+
+    return notes
+
+# the metadata cache maps the filename of each .json note file to:
+# [[mtime, size, inode], note without content, title, text filename]
+METADATA_CACHE_MAGIC = 'NVPY-METADATA 1'
+
+def read_metadata_cache(fn):
+    """Read the metadata cache.
+
+    @param fn: filename of the cache.
+    @returns: dictionary mapping .json filename to cache entry, empty if
+    there is no valid cache.
+    """
+
+    try:
+        with open(fn, 'rb') as f:
+            data = f.read()
+
+    except IOError:
+        return {}
+
+    magic_end = data.find('\n')
+    if data[:magic_end] != METADATA_CACHE_MAGIC:
+        return {}
+
+    try:
+        cache = json.loads(zlib.decompress(data[magic_end + 1:]))
+
+    except (ValueError, zlib.error):
+        return {}
+
+    if not isinstance(cache, dict):
+        return {}
+
+    return cache
+
+def write_metadata_cache(fn, cache):
+    """Replace the metadata cache.
+
+    @param fn: filename of the cache.
+    @param cache: dictionary mapping .json filename to cache entry.
+    """
+
+    data = zlib.compress(json.dumps(cache, separators=(',', ':')))
+    write_atomic(fn, '%s\n%s' % (METADATA_CACHE_MAGIC, data))
+
+# the write-ahead log records note saves as one compact json object per line:
+# s: sequence number, k: local key,
+# f: changed fields, r: removed fields,
+# c: [start, end, text, old length] splice for the content field,
+# x: note was removed from the database.
+# every note file written out during compaction carries the sequence number
+# of the last record applied to the note in its walseq field, so that
+# replaying a log on top of a partially compacted database is harmless.
+# walseq only exists on disc, see pop_walseqs().
+WAL_IGNORE_FIELDS = ('savedate', 'walseq')
+
+def pop_walseqs(notes):
+    """Remove the walseq field from notes as read from disc.
+
+    @param notes: dictionary mapping local key to note dictionary.
+    @returns: dictionary mapping local key to walseq, for the notes that
+    had one.
+    """
+
+    return dict([(k, n.pop('walseq')) for k, n in notes.items() if 'walseq' in n])
+
+def _common_prefix_len(a, b):
+    """Length of common prefix of a and b, using slice comparisons.
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+def _common_suffix_len(a, b, limit):
+    """Length of common suffix of a and b, at most limit.
+    """
+    la, lb = len(a), len(b)
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+def wal_record(k, old, new):
+    """Determine the write-ahead log record that turns old into new.
+
+    @param k: local key of the note.
+    @param old: note as it was last logged, or None for a new note.
+    @param new: note as it has to be saved now.
+    @returns: record dictionary (without sequence number) or None if nothing
+    changed.
+    """
+
+    fields = {}
+    removed = []
+    splice = None
+
+    if old is None:
+        old = {}
+
+    for f, v in new.items():
+        if f in WAL_IGNORE_FIELDS or (f in old and old[f] == v):
+            continue
+
+        oc = old.get(f)
+        if f == 'content' and type(oc) == type(v) and isinstance(v, basestring):
+            p = _common_prefix_len(oc, v)
+            s = _common_suffix_len(oc, v, min(len(oc), len(v)) - p)
+            splice = [p, len(oc) - s, v[p:len(v) - s], len(oc)]
+
+        else:
+            fields[f] = v
+
+    for f in old:
+        if f not in new and f not in WAL_IGNORE_FIELDS:
+            removed.append(f)
+
+    if not (fields or removed or splice):
+        return None
+
+    r = {'k' : k}
+    if fields:
+        r['f'] = fields
+    if removed:
+        r['r'] = removed
+    if splice:
+        r['c'] = splice
+
+    return r
+
+def wal_apply(notes, r, walseqs):
+    """Apply a single write-ahead log record to notes.
+
+    @param notes: dictionary mapping local key to note dictionary.
+    @param r: record as read back from the log.
+    @param walseqs: dictionary mapping local key to the sequence number of
+    the last record applied to the note, see pop_walseqs(). Updated in
+    place.
+    @returns: local key of the note that was changed, or None if the
+    record had already been applied.
+    @raises ValueError: if the record does not fit the note it applies to.
+    """
+
+    k = r['k']
+    n = notes.get(k)
+    if n is not None and walseqs.get(k, -1) >= r['s']:
+        return None
+
+    if r.get('x'):
+        if k in notes:
+            del notes[k]
+        walseqs.pop(k, None)
+        return k
+
+    if n is None:
+        n = notes[k] = {}
+
+    if 'c' in r:
+        start, end, text, oldlen = r['c']
+        c = n.get('content', '')
+        if len(c) != oldlen:
+            raise ValueError('Write-ahead log content mismatch for note %s' % (k,))
+
+        n['content'] = c[:start] + text + c[end:]
+
+    n.update(r.get('f', {}))
+    for f in r.get('r', []):
+        n.pop(f, None)
+
+    walseqs[k] = r['s']
+    return k
+
+class WriteAheadLog:
+    """Append-only log file of note changes.
+
+    To be compacted, the log is first rotated: its records move to a second
+    file, and new records go to a fresh log. Until the rotated log is
+    removed, reading covers both files, oldest records first.
+
+    @ivar positions: list of (filename, offset) of each record returned by
+    the last read_records().
+    @ivar end: (filename, offset) where the valid part of the log ends.
+    @ivar torn: True if read_records() had to stop at an invalid line.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.old_fn = fn + '.old'
+        self.f = None
+        self.positions = []
+        self.end = (self.old_fn, 0)
+        self.torn = False
+
+    def read_records(self):
+        """Return all valid records at the start of the log.
+
+        Reading stops at the first line that is not a valid record, such
+        as a torn last line after a crash during append. See truncate() to
+        drop that and everything after it.
+        """
+
+        records = []
+        self.positions = []
+        self.end = (self.old_fn, 0)
+        self.torn = False
+
+        for fn in (self.old_fn, self.fn):
+            if not os.path.isfile(fn):
+                continue
+
+            f = open(fn, 'rb')
+            try:
+                data = f.read()
+
+            finally:
+                f.close()
+
+            offset = 0
+            while offset < len(data):
+                nl = data.find('\n', offset)
+                try:
+                    if nl < 0:
+                        raise ValueError('Incomplete record')
+
+                    r = json.loads(data[offset:nl])
+                    if not isinstance(r, dict) or 'k' not in r or not isinstance(r.get('s'), (int, long)):
+                        raise ValueError('Invalid record')
+
+                except ValueError:
+                    self.end = (fn, offset)
+                    self.torn = True
+                    return records
+
+                # a rotation that was interrupted can leave records in both
+                # files. sequence numbers only increase, so we skip those.
+                if not records or r['s'] > records[-1]['s']:
+                    records.append(r)
+                    self.positions.append((fn, offset))
+
+                offset = nl + 1
+
+            self.end = (fn, offset)
+
+        return records
+
+    def append(self, records, batch=None):
+        """Append records to the log.
+
+        @param records: list of record dictionaries, each with its sequence
+        number in s.
+        @param batch: AtomicWriteBatch that flushes the log, or None to leave
+        that to the OS.
+        """
+
+        if self.f is None:
+            self.f = open(self.fn, 'ab')
+
+        self.f.write(''.join([json.dumps(r, separators=(',', ':')) + '\n' for r in records]))
+        self.f.flush()
+        if batch is not None:
+            batch.sync_file(self.f)
+
+    def size(self):
+        """Size in bytes of the log, without the rotated log.
+        """
+
+        if self.f is not None:
+            return os.fstat(self.f.fileno()).st_size
+
+        elif os.path.isfile(self.fn):
+            return os.path.getsize(self.fn)
+
+        else:
+            return 0
+
+    def truncate(self, i=0):
+        """Drop record i, as returned by read_records(), and all records
+        after it. The default empties the log, including the rotated log.
+        """
+
+        if i == 0:
+            fn, offset = self.old_fn, 0
+
+        elif i < len(self.positions):
+            fn, offset = self.positions[i]
+
+        else:
+            fn, offset = self.end
+
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+        if fn == self.old_fn:
+            _truncate_file(self.old_fn, offset)
+            _truncate_file(self.fn, 0)
+
+        else:
+            _truncate_file(self.fn, offset)
+
+        self.positions = self.positions[:i]
+        self.end = (fn, offset)
+
+    def rotate(self):
+        """Move all records to the rotated log, so that the log can be
+        compacted while new records are appended.
+        """
+
+        if self.f is not None:
+            # batches that still have to flush the log can't do that
+            # anymore once it is closed.
+            _fdatasync(self.f.fileno())
+            self.f.close()
+            self.f = None
+
+        if not os.path.isfile(self.fn):
+            return
+
+        if os.path.isfile(self.old_fn):
+            # the previous compaction did not finish, so this one has to
+            # cover its records as well.
+            f = open(self.fn, 'rb')
+            try:
+                data = f.read()
+
+            finally:
+                f.close()
+
+            f = open(self.old_fn, 'ab')
+            try:
+                f.write(data)
+                f.flush()
+                _fdatasync(f.fileno())
+
+            finally:
+                f.close()
+
+            _truncate_file(self.fn, 0)
+
+        else:
+            _replace(self.fn, self.old_fn)
+            fsync_dir(os.path.dirname(os.path.abspath(self.fn)))
+
+    def rotated(self):
+        """Is there a rotated log that has not been removed yet?
+        """
+        return os.path.isfile(self.old_fn)
+
+    def remove_rotated(self):
+        """Remove the rotated log once its records have been compacted.
+        """
+
+        if os.path.isfile(self.old_fn):
+            os.unlink(self.old_fn)
+
+def _truncate_file(fn, offset):
+    """Cut file fn off at offset, removing it if offset is 0.
+    """
+
+    if offset == 0:
+        if os.path.isfile(fn):
+            os.unlink(fn)
+
+        return
+
+    f = open(fn, 'r+b')
+    try:
+        f.truncate(offset)
+
+    finally:
+        f.close()
+
+# the search indexes of lazy content mode keep their postings in an sqlite
+# database, see PostingsStore. it only caches what can be computed from the
+# notes, so it can always be thrown away.
+SearchIndexError = sqlite3.Error
+
+def _connect_search_index(fn):
+    db = sqlite3.connect(fn)
+    # with write-ahead logging, a crash never leaves a broken database, and
+    # commits don't have to be flushed to disc.
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute('SELECT count(*) FROM sqlite_master').fetchall()
+    return db
+
+def open_search_index(fn):
+    """Open the database of the search indexes, see PostingsStore.
+
+    A database that can't be read is replaced by an empty one.
+
+    @param fn: filename of the database.
+    @raises SearchIndexError: if no database could be opened at all.
+    """
+
+    try:
+        return _connect_search_index(fn)
+
+    except sqlite3.DatabaseError:
+        for dfn in (fn, fn + '-wal', fn + '-shm'):
+            if os.path.isfile(dfn):
+                os.unlink(dfn)
+
+        return _connect_search_index(fn)
+
+class PostingsStore:
+    """Postings of a search index, in a database on disc instead of in
+    memory.
+
+    Several stores can share one database, each in its own tables. Every
+    note is stored with a stamp, so that the index can tell which notes
+    changed since they were indexed.
+    """
+
+    def __init__(self, db, name, substrings=False):
+        """
+        @param db: database, see open_search_index().
+        @param name: name of the index, which prefixes its tables.
+        @param substrings: if True, keep a vocabulary of all tokens for
+        get_keys_containing().
+        """
+
+        self.db = db
+        self.notes = name + '_notes'
+        self.postings = name + '_postings'
+        self.vocab = name + '_vocab' if substrings else None
+
+        # postings refer to notes by a small integer id instead of their
+        # key, which keeps the database at a fraction of the size. the
+        # tokens of each note are kept with it as well, so that updates
+        # don't need a second index on the postings.
+        db.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, key TEXT UNIQUE, '
+                   'stamp TEXT, tokens TEXT)' % (self.notes,))
+        db.execute('CREATE TABLE IF NOT EXISTS %s (token TEXT, id INTEGER, '
+                   'PRIMARY KEY (token, id)) WITHOUT ROWID' % (self.postings,))
+        if self.vocab:
+            # count is the number of notes with the token
+            db.execute('CREATE TABLE IF NOT EXISTS %s (token TEXT PRIMARY KEY, count INTEGER) '
+                       'WITHOUT ROWID' % (self.vocab,))
+
+        db.commit()
+
+    def get_stamps(self):
+        """Return dictionary mapping local key to stamp of all notes in the
+        index.
+        """
+        return dict(self.db.execute('SELECT key, stamp FROM %s' % (self.notes,)))
+
+    def get_keys(self, token):
+        """Return set of local keys of the notes with token.
+        """
+        return set([k for (k,) in self.db.execute(
+            'SELECT n.key FROM %s p JOIN %s n ON n.id = p.id WHERE p.token = ?'
+            % (self.postings, self.notes), (token,))])
+
+    def get_keys_containing(self, s):
+        """Return set of local keys of the notes with a token that contains
+        the string s.
+        """
+
+        pattern = u'%' + s.replace(u'\\', u'\\\\').replace(u'%', u'\\%').replace(u'_', u'\\_') + u'%'
+        return set([k for (k,) in self.db.execute(
+            'SELECT DISTINCT n.key FROM %s v JOIN %s p ON p.token = v.token JOIN %s n ON n.id = p.id '
+            'WHERE v.token LIKE ? ESCAPE ?' % (self.vocab, self.postings, self.notes), (pattern, u'\\'))])
+
+    def update(self, k, tokens, stamp):
+        """Replace the tokens of note k.
+
+        @param tokens: iterable of tokens.
+        @param stamp: string to store with them, or None if the note has to
+        be removed from the index.
+        """
+
+        tokens = set(tokens)
+        row = self.db.execute('SELECT id, tokens FROM %s WHERE key = ?' % (self.notes,), (k,)).fetchone()
+        if row is None:
+            if stamp is None:
+                return
+
+            i = self.db.execute('INSERT INTO %s (key) VALUES (?)' % (self.notes,), (k,)).lastrowid
+            old = set()
+
+        else:
+            i = row[0]
+            old = set(json.loads(row[1])) if row[1] else set()
+
+        removed = [(t,) for t in old - tokens]
+        added = [(t,) for t in tokens - old]
+
+        self.db.executemany('DELETE FROM %s WHERE token = ? AND id = ?' % (self.postings,),
+                            [(t, i) for (t,) in removed])
+        self.db.executemany('INSERT INTO %s (token, id) VALUES (?, ?)' % (self.postings,),
+                            [(t, i) for (t,) in added])
+
+        if self.vocab:
+            self.db.executemany('INSERT OR IGNORE INTO %s (token, count) VALUES (?, 0)' % (self.vocab,), added)
+            self.db.executemany('UPDATE %s SET count = count + 1 WHERE token = ?' % (self.vocab,), added)
+            self.db.executemany('UPDATE %s SET count = count - 1 WHERE token = ?' % (self.vocab,), removed)
+            self.db.executemany('DELETE FROM %s WHERE token = ? AND count <= 0' % (self.vocab,), removed)
+
+        if stamp is None:
+            self.db.execute('DELETE FROM %s WHERE id = ?' % (self.notes,), (i,))
+
+        else:
+            self.db.execute('UPDATE %s SET stamp = ?, tokens = ? WHERE id = ?' % (self.notes,),
+                            (stamp, json.dumps(sorted(tokens)), i))
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
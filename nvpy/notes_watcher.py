@@ -0,0 +1,162 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+# watchers that tell NotesDB which text files in txt_path were changed by
+# other programs.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+# inotify constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+# struct inotify_event without the name that follows it
+_event_struct = struct.Struct('iIII')
+
+class PollingWatcher:
+    """Find changed files by comparing their stats with those of the
+    previous poll.
+
+    @ivar stats: dictionary mapping filename to (mtime, size, inode).
+    """
+
+    def __init__(self, path, suffixes):
+        """
+        @param path: directory to watch.
+        @param suffixes: tuple of filename suffixes of the files to watch.
+        """
+
+        self.path = path
+        self.suffixes = suffixes
+        self.stats = self.helper_scan()
+
+    def helper_scan(self):
+        stats = {}
+        for fn in os.listdir(self.path):
+            if not fn.endswith(self.suffixes):
+                continue
+
+            try:
+                st = os.stat(os.path.join(self.path, fn))
+
+            except OSError:
+                # removed while we were looking
+                continue
+
+            stats[fn] = (st.st_mtime, st.st_size, st.st_ino)
+
+        return stats
+
+    def poll(self):
+        """Return set of filenames that were created, changed or removed
+        since the previous poll.
+        """
+
+        stats = self.helper_scan()
+        changed = set([fn for fn, st in stats.items() if self.stats.get(fn) != st])
+        changed.update([fn for fn in self.stats if fn not in stats])
+        self.stats = stats
+
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """Find changed files with Linux inotify, so that a poll costs a single
+    non-blocking read instead of a directory scan.
+    """
+
+    # files are only reported once they are completely written.
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+    def __init__(self, path, suffixes):
+        """
+        @raises OSError: if inotify is not available.
+        """
+
+        self.path = path
+        self.suffixes = suffixes
+
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_name is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        bpath = path.encode(sys.getfilesystemencoding()) if isinstance(path, unicode) else path
+        if inotify_add_watch(self.fd, bpath, self.MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e))
+
+    def poll(self):
+        """Return set of filenames that were created, changed or removed
+        since the previous poll.
+        """
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, name_len = _event_struct.unpack_from(data, i)
+                i += _event_struct.size
+                name = data[i:i + name_len].rstrip('\0')
+                i += name_len
+
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so anything could have changed.
+                    changed.update([fn for fn in os.listdir(self.path) if fn.endswith(self.suffixes)])
+                    continue
+
+                fn = name.decode(sys.getfilesystemencoding(), 'replace')
+                if fn.endswith(self.suffixes):
+                    changed.add(fn)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def create_watcher(path, suffixes):
+    """Return an InotifyWatcher for path if possible, else a PollingWatcher.
+
+    @param path: directory to watch, as unicode.
+    @param suffixes: tuple of filename suffixes of the files to watch.
+    """
+
+    try:
+        return InotifyWatcher(path, suffixes)
+
+    except OSError:
+        return PollingWatcher(path, suffixes)
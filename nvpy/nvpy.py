@@ -34,7 +34,7 @@ import codecs
 import ConfigParser
 import logging
 from logging.handlers import RotatingFileHandler
-from notes_db import NotesDB, SyncError, ReadError, WriteError
+from notes_db import NotesDB, ReadError, WriteError
 import os
 import sys
 import time
@@ -60,6 +60,16 @@ else:
 
 VERSION = "0.9.4"
 
+# results of the background full sync are applied on the Tk thread in
+# batches of this many, every so many milliseconds. the notes list is
+# refreshed at most once per SYNC_FULL_REFRESH_S seconds meanwhile.
+SYNC_FULL_APPLY_BATCH = 100
+SYNC_FULL_APPLY_MS = 100
+SYNC_FULL_REFRESH_S = 1.0
+
+# on exit, we wait at most this many seconds for pending saves.
+SAVE_FLUSH_TIMEOUT_S = 10.0
+
 class Config:
     """
     @ivar files_read: list of config files that were parsed.
@@ -79,12 +89,26 @@ class Config:
                     'home' : home,
                     'notes_as_txt' : '0',
                     'housekeeping_interval' : '2',
+                    'save_interval' : '3',
                     'search_mode' : 'gstyle',
                     'case_sensitive' : '1',
+                    'search_normalize' : 'lower',
+                    'search_cache_normalized' : '1',
                     'search_tags' : '1',
                     'sort_mode' : '1',
                     'pinned_ontop' : '1',
                     'db_path' : os.path.join(home, '.nvpy'),
+                    'db_snapshot' : '0',
+                    'db_wal' : '0',
+                    'wal_compact_size' : '4194304',
+                    'db_durability' : 'batch',
+                    'db_compact' : '0',
+                    'db_compress_size' : '0',
+                    'db_lazy_content' : '0',
+                    'content_cache_size' : '100',
+                    'load_threads' : '4',
+                    'load_processes' : '0',
+                    'txt_watch' : '1',
                     'txt_path' : os.path.join(home, '.nvpy/notes'),
                     'font_family' : 'Courier', # monospaced on all platforms
                     'font_size' : '10',
@@ -97,6 +121,9 @@ class Config:
                     'sn_username' : '',
                     'sn_password' : '',
                     'simplenote_sync' : '1',
+                    'sync_threads' : '4',
+                    'http_pool_size' : '4',
+                    'http_idle_timeout' : '60',
                     # Filename or filepath to a css file used style the rendered
                     # output; e.g. nvpy.css or /path/to/my.css
                     'rest_css_path': None,
@@ -126,18 +153,50 @@ class Config:
         self.sn_username = cp.get(cfg_sec, 'sn_username', raw=True)
         self.sn_password = cp.get(cfg_sec, 'sn_password', raw=True)
         self.simplenote_sync = cp.getint(cfg_sec, 'simplenote_sync')
+        # number of notes a full sync transfers concurrently
+        self.sync_threads = cp.getint(cfg_sec, 'sync_threads')
+        # idle keep-alive connections to simplenote, and for how many seconds
+        self.http_pool_size = cp.getint(cfg_sec, 'http_pool_size')
+        self.http_idle_timeout = cp.getint(cfg_sec, 'http_idle_timeout')
         # make logic to find in $HOME if not set
         self.db_path = cp.get(cfg_sec, 'db_path')
+        # 1 = also keep all notes in a single snapshot file for fast startup
+        self.db_snapshot = cp.getint(cfg_sec, 'db_snapshot')
+        # 1 = log note changes instead of rewriting whole .json files
+        self.db_wal = cp.getint(cfg_sec, 'db_wal')
+        self.wal_compact_size = cp.getint(cfg_sec, 'wal_compact_size')
+        # none, batch or note: when saved notes are flushed to disc
+        self.db_durability = cp.get(cfg_sec, 'db_durability')
+        # 1 = write note files without indentation
+        self.db_compact = cp.getint(cfg_sec, 'db_compact')
+        # notes larger than this many bytes are compressed, 0 = never
+        self.db_compress_size = cp.getint(cfg_sec, 'db_compress_size')
+        # 1 = only keep contents of the content_cache_size most recently used
+        # notes in memory, and the search indexes on disc
+        self.db_lazy_content = cp.getint(cfg_sec, 'db_lazy_content')
+        self.content_cache_size = cp.getint(cfg_sec, 'content_cache_size')
+        # number of threads reading, and of processes decoding large notes
+        # at startup, 0 = no processes
+        self.load_threads = cp.getint(cfg_sec, 'load_threads')
+        self.load_processes = cp.getint(cfg_sec, 'load_processes')
         #  0 = alpha sort, 1 = last modified first
         self.notes_as_txt = cp.getint(cfg_sec, 'notes_as_txt')
         self.txt_path = os.path.join(home, cp.get(cfg_sec, 'txt_path'))
+        # 1 = pick up changes other programs make to the text notes
+        self.txt_watch = cp.getint(cfg_sec, 'txt_watch')
         self.search_mode = cp.get(cfg_sec, 'search_mode')
         self.case_sensitive = cp.getint(cfg_sec, 'case_sensitive')
+        # lower = case insensitive search only ignores case, fold = also accents
+        self.search_normalize = cp.get(cfg_sec, 'search_normalize')
+        # 1 = keep normalized copy of each note in memory (faster, more memory)
+        self.search_cache_normalized = cp.getint(cfg_sec, 'search_cache_normalized')
         self.search_tags = cp.getint(cfg_sec, 'search_tags')
         self.sort_mode = cp.getint(cfg_sec, 'sort_mode')
         self.pinned_ontop = cp.getint(cfg_sec, 'pinned_ontop')
         self.housekeeping_interval = cp.getint(cfg_sec, 'housekeeping_interval')
         self.housekeeping_interval_ms = self.housekeeping_interval * 1000
+        # each note is written to disc at most once every this many seconds
+        self.save_interval = cp.getfloat(cfg_sec, 'save_interval')
 
         self.font_family = cp.get(cfg_sec, 'font_family')
         self.font_size = cp.getint(cfg_sec, 'font_size')
@@ -157,27 +216,61 @@ class Config:
 class NotesListModel(SubjectMixin):
     """
     @ivar list: List of (str key, dict note) objects.
+    @ivar notes_db: NotesDB the notes in list come from.
+    @ivar key_idxs: dictionary mapping local key to its index in list.
     """
     def __init__(self):
         # call mixin ctor
         SubjectMixin.__init__(self)
 
         self.list = []
+        self.key_idxs = {}
+        self.notes_db = None
         self.match_regexps = []
 
     def set_list(self, alist):
         self.list = alist
+        self.key_idxs = dict([(o.key, i) for i, o in enumerate(alist)])
         self.notify_observers('set:list', None)
 
     def get_idx(self, key):
         """Find idx for passed LOCAL key.
+
+        @returns: index in list, or -1 if the key is not in the list.
         """
-        found = [i for i,e in enumerate(self.list) if e.key == key]
-        if found:
-            return found[0]
+        return self.key_idxs.get(key, -1)
 
-        else:
-            return -1
+    def get_idxs(self, keys):
+        """Find idxs for passed LOCAL keys.
+
+        @param keys: iterable of local keys.
+        @returns: sorted list of the indexes of those keys that are in the
+        list.
+        """
+        return sorted([self.key_idxs[k] for k in keys if k in self.key_idxs])
+
+    def get_note_title(self, key):
+        """Return title of note with LOCAL key.
+        """
+        return self.notes_db.get_note_title(key)
+
+    def get_changed_keys(self):
+        """Return set of LOCAL keys of the notes that changed since the
+        previous call, see NotesDB.get_changed_keys().
+        """
+        return self.notes_db.get_changed_keys('view')
+
+    def rekey(self, rekeyed):
+        """Change the keys of listed notes in place.
+
+        @param rekeyed: dictionary mapping old to new local key.
+        """
+
+        for old_key, new_key in rekeyed.items():
+            idx = self.key_idxs.pop(old_key, None)
+            if idx is not None:
+                self.list[idx].key = new_key
+                self.key_idxs[new_key] = idx
 
 class Controller:
     """Main application class.
@@ -251,6 +344,7 @@ class Controller:
             self.view.show_error('Sync error', emsg)
             exit(1)
 
+        self.notes_list_model.notes_db = self.notes_db
 
         self.notes_db.add_observer('synced:note', self.observer_notes_db_synced_note)
         self.notes_db.add_observer('change:note-status', self.observer_notes_db_change_note_status)
@@ -338,21 +432,25 @@ class Controller:
         # we overwrite.
 
         if selected_note_o.key == evt.lkey:
-            if selected_note_o.note['content'] != evt.old_note['content']:
+            note = self.notes_db.get_note(evt.lkey)
+            if note['content'] != evt.old_note['content']:
                 self.view.mute_note_data_changes()
                 # in this case, we want to keep the user's undo buffer so that they
                 # can undo synced back changes if they would want to.
-                self.view.set_note_data(selected_note_o.note, reset_undo=False)
+                self.view.set_note_data(note, reset_undo=False)
                 self.view.unmute_note_data_changes()
 
     def observer_view_click_notelink(self, view, evt_type, note_name):
         # find note_name in titles, try to jump to that note
         # if not in current list, change search string in case
         # it's somewhere else
-        # FIXME: implement find_note_by_name
-        idx = self.view.select_note_by_name(note_name)
+        idxs = self.notes_list_model.get_idxs(self.notes_db.get_keys_by_title(note_name))
 
-        if idx < 0:
+        if idxs:
+            # the first of the notes with that name in the list
+            self.view.select_note(idxs[0], silent=False)
+
+        else:
             # this means a note with that name was not found
             # because nvpy kicks ass, it then assumes the contents of [[]]
             # to be a new regular expression to search for in the notes db.
@@ -470,17 +568,24 @@ class Controller:
         if self.config.simplenote_sync:
             syncn = self.notes_db.get_sync_queue_len()
             wfsn = self.notes_db.waiting_for_simplenote
+            fsn = self.notes_db.sync_full_running
         else:
-            syncn = wfsn = 0
+            syncn = wfsn = fsn = 0
 
         savet = 'Saving %d notes.' % (saven,) if saven > 0 else '';
         synct = 'Waiting to sync %d notes.' % (syncn,) if syncn > 0 else '';
         wfsnt = 'Syncing with simplenote server.' if wfsn else '';
+        fsnt = 'Full sync in progress.' if fsn else '';
 
-        return ' '.join([i for i in [savet, synct, wfsnt] if i])
+        return ' '.join([i for i in [savet, synct, wfsnt, fsnt] if i])
 
 
     def observer_view_keep_house(self, view, evt_type, evt):
+        # text notes changed by other programs. refreshing the list also
+        # updates the selected note if it was changed.
+        if self.notes_db.apply_txt_changes():
+            self.view.refresh_notes_list()
+
         # queue up all notes that need to be saved
         nsaved = self.notes_db.save_threaded()
         msg = self.helper_save_sync_msg()
@@ -507,7 +612,7 @@ class Controller:
             ret = self.notes_db.sync_note_unthreaded(key)
             if ret and ret[1] == True:
                 self.view.update_selected_note_data(
-                        self.notes_db.notes[key])
+                        self.notes_db.get_note(key))
                 self.view.set_status_text(
                 'Synced updated note from server.')
 
@@ -606,27 +711,34 @@ class Controller:
     def observer_view_close(self, view, evt_type, evt):
         # check that everything has been saved and synced before exiting
 
-        # first make sure all our queues are up to date
-        self.notes_db.save_threaded()
+        # first make sure all our queues are up to date, and write out
+        # the saves that are still waiting for their save_interval.
+        self.notes_db.flush_saves(SAVE_FLUSH_TIMEOUT_S)
         if self.config.simplenote_sync:
             self.notes_db.sync_to_server_threaded(wait_for_idle=False)
             syncn = self.notes_db.get_sync_queue_len()
             wfsn = self.notes_db.waiting_for_simplenote
+            fsn = self.notes_db.sync_full_running
         else:
-            syncn = wfsn = 0
+            syncn = wfsn = fsn = 0
 
         # then check all queues
         saven = self.notes_db.get_save_queue_len()
 
         # if there's still something to do, warn the user.
-        if saven or syncn or wfsn:
+        if saven or syncn or wfsn or fsn:
             msg = "Are you sure you want to exit? I'm still busy: " + self.helper_save_sync_msg()
             really_want_to_exit = self.view.askyesno("Confirm exit", msg)
 
             if really_want_to_exit:
+                self.notes_db.close()
                 self.view.close()
 
         else:
+            # everything has been saved, so we can consolidate for the
+            # next startup.
+            self.notes_db.checkpoint()
+            self.notes_db.close()
             self.view.close()
 
     def observer_view_create_note(self, view, evt_type, evt):
@@ -677,24 +789,46 @@ class Controller:
         self.view.unmute_note_data_changes()
 
     def sync_full(self):
+        # the sync talks to the server in the background, we apply its
+        # results here on the Tk thread, see helper_sync_full_apply().
+        if self.notes_db.sync_full_threaded():
+            self.sync_full_refreshed = time.time()
+            self.sync_full_changed = False
+            self.view.after(SYNC_FULL_APPLY_MS, self.helper_sync_full_apply)
+
+    def helper_sync_full_apply(self):
         try:
-            sync_from_server_errors = self.notes_db.sync_full()
+            res = self.notes_db.sync_full_apply(max_results=SYNC_FULL_APPLY_BATCH)
 
-        except SyncError, e:
-            self.view.show_error('Sync error', e)
         except WriteError, e:
             emsg = "Please check nvpy.log.\n" + str(e)
             self.view.show_error('Sync error', emsg)
             exit(1)
 
-        else:
+        if res.rekeyed:
+            # new notes got their server keys. we update the listed keys, so
+            # that the selection survives the refresh.
+            self.notes_list_model.rekey(res.rekeyed)
+
+        self.sync_full_changed = self.sync_full_changed or res.changed
+        if self.sync_full_changed and \
+           (res.done or res.rekeyed or time.time() - self.sync_full_refreshed > SYNC_FULL_REFRESH_S):
             # regenerate display list
             # reselect old selection
             # put cursor where it used to be.
             self.view.refresh_notes_list()
+            self.sync_full_changed = False
+            self.sync_full_refreshed = time.time()
 
-            if sync_from_server_errors > 0:
-                self.view.show_error('Error syncing notes from server', 'Error syncing %d notes from server. Please check nvpy.log for details.' % (sync_from_server_errors,))
+        if res.done:
+            if res.error is not None:
+                self.view.show_error('Sync error', res.error)
+
+            elif res.errors > 0:
+                self.view.show_error('Error syncing notes from server', 'Error syncing %d notes from server. Please check nvpy.log for details.' % (res.errors,))
+
+        else:
+            self.view.after(SYNC_FULL_APPLY_MS, self.helper_sync_full_apply)
 
 
 def main():
@@ -13,6 +13,13 @@ import urllib
 import urllib2
 from urllib2 import HTTPError
 import base64
+import errno
+import httplib
+import select
+import socket
+from StringIO import StringIO
+import threading
+import time
 try:
     import json
 except ImportError:
@@ -30,11 +37,25 @@ NOTE_FETCH_LENGTH = 20
 class Simplenote(object):
     """ Class for interacting with the simplenote web service """
 
-    def __init__(self, username, password):
-        """ object constructor """
+    def __init__(self, username, password, pool_size=4, idle_timeout=60):
+        """ object constructor
+
+        Arguments:
+            - pool_size (int): number of idle keep-alive connections to keep
+            - idle_timeout (int): seconds after which an idle connection is
+              not reused anymore
+
+        """
         self.username = urllib2.quote(username)
         self.password = urllib2.quote(password)
         self.token = None
+        # all requests, from whichever thread, share these connections
+        self.pool = ConnectionPool(pool_size, idle_timeout)
+        self.opener = urllib2.build_opener(KeepAliveHTTPSHandler(self.pool))
+
+    def urlopen(self, request):
+        """ urllib2.urlopen replacement that reuses pooled connections """
+        return self.opener.open(request)
 
     def authenticate(self, user, password):
         """ Method to get simplenote auth token
@@ -51,7 +72,7 @@ class Simplenote(object):
         values = base64.encodestring(auth_params)
         request = Request(AUTH_URL, values)
         try:
-            res = urllib2.urlopen(request).read()
+            res = self.urlopen(request).read()
             token = urllib2.quote(res)
         except IOError: # no connection exception
             token = None
@@ -90,7 +111,7 @@ class Simplenote(object):
                                            self.username)
         request = Request(DATA_URL+params)
         try:
-            response = urllib2.urlopen(request)
+            response = self.urlopen(request)
         except HTTPError, e:
             return e, -1
         except IOError, e:
@@ -120,6 +141,9 @@ class Simplenote(object):
 
         """
 
+        # we change fields below, but the caller's note stays as it is
+        note = dict(note)
+
         # use UTF-8 encoding
         # cpbotha: in both cases check if it's not unicode already
         # otherwise you get "TypeError: decoding Unicode is not supported"
@@ -141,7 +165,7 @@ class Simplenote(object):
         request = Request(url, urllib.quote(json.dumps(note)))
         response = ""
         try:
-            response = urllib2.urlopen(request).read()
+            response = self.urlopen(request).read()
         except IOError, e:
             return e, -1
         return json.loads(response), 0
@@ -171,7 +195,7 @@ class Simplenote(object):
         else:
             return "No string or valid note.", -1
 
-    def get_note_list(self, qty=float("inf")):
+    def get_note_list(self, qty=float("inf"), since=None):
         """ function to get the note list
 
         The function can be passed an optional argument to limit the
@@ -180,53 +204,64 @@ class Simplenote(object):
 
         Arguments:
             - quantity (integer number): of notes to list
+            - since (float): only list notes modified after this timestamp
 
         Returns:
             An array of note objects with all properties set except
             `content`.
 
         """
-        # initialize data
         status = 0
         ret = []
-        response = {}
-        notes = { "data" : [] }
-
-        # get the note index
-        if qty < NOTE_FETCH_LENGTH:
-            params = 'auth=%s&email=%s&length=%s' % (self.get_token(), self.username,
-                                                 qty)
-        else:
-            params = 'auth=%s&email=%s&length=%s' % (self.get_token(), self.username,
-                                                 NOTE_FETCH_LENGTH)
-        # perform initial HTTP request
         try:
-            request = Request(INDX_URL+params)
-            response = json.loads(urllib2.urlopen(request).read())
-            notes["data"].extend(response["data"])
+            for note in self.iter_note_list(qty, since):
+                ret.append(note)
         except IOError:
             status = -1
 
-        # get additional notes if bookmark was set in response
-        while response.has_key("mark") and len(notes["data"]) < qty:
-            if (qty - len(notes["data"])) < NOTE_FETCH_LENGTH:
-                vals = (self.get_token(), self.username, response["mark"], qty - len(notes["data"]))
-            else:
-                vals = (self.get_token(), self.username, response["mark"], NOTE_FETCH_LENGTH)
-            params = 'auth=%s&email=%s&mark=%s&length=%s' % vals
+        return ret, status
+
+    def iter_note_list(self, qty=float("inf"), since=None):
+        """ generator variant of get_note_list
+
+        Each page of the index is requested only when the entries of the
+        previous one have been consumed, so the caller can start working on
+        the first notes while the rest of the index is still to come.
+
+        Arguments:
+            - quantity (integer number): of notes to list
+            - since (float): only list notes modified after this timestamp
+
+        Yields:
+            Note objects with all properties set except `content`.
+
+        Raises:
+            IOError if a page could not be retrieved.
+
+        """
+        count = 0
+        mark = None
+        while count < qty:
+            length = min(qty - count, NOTE_FETCH_LENGTH)
+            params = 'auth=%s&email=%s' % (self.get_token(), self.username)
+            # get additional notes if bookmark was set in response
+            if mark is not None:
+                params += '&mark=%s' % (mark,)
+            params += '&length=%s' % (length,)
+            if since is not None:
+                params += '&since=%s' % (repr(float(since)),)
 
             # perform the actual HTTP request
-            try:
-                request = Request(INDX_URL+params)
-                response = json.loads(urllib2.urlopen(request).read())
-                notes["data"].extend(response["data"])
-            except IOError:
-                status = -1
+            request = Request(INDX_URL+params)
+            response = json.loads(self.urlopen(request).read())
+            for note in response["data"]:
+                count += 1
+                yield note
 
-        # parse data fields in response
-        ret = notes["data"]
+            if not response.has_key("mark"):
+                break
 
-        return ret, status
+            mark = response["mark"]
 
     def trash_note(self, note_id):
         """ method to move a note to the trash
@@ -272,12 +307,159 @@ class Simplenote(object):
                                            self.username)
         request = Request(url=DATA_URL+params, method='DELETE')
         try:
-            urllib2.urlopen(request)
+            self.urlopen(request)
         except IOError, e:
             return e, -1
         return {}, 0
 
 
+class ConnectionPool(object):
+    """ thread-safe pool of idle keep-alive HTTPS connections """
+
+    def __init__(self, size, idle_timeout):
+        """ object constructor
+
+        Arguments:
+            - size (int): maximum number of idle connections per host
+            - idle_timeout (int): seconds after which an idle connection is
+              closed instead of reused
+
+        """
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # (host, tunnel host) -> list of (connection, time put back)
+        self.idle = {}
+
+    def get(self, host, tunnel_host, tunnel_headers, timeout):
+        """ method to get a connection to host
+
+        Returns:
+            A tuple `(connection, reused)`
+
+            - connection (httplib.HTTPSConnection): connection to use
+            - reused (bool): True if the connection was used before
+
+        """
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get((host, tunnel_host), [])
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout and not _connection_dropped(conn):
+                    return conn, True
+
+                conn.close()
+
+        conn = httplib.HTTPSConnection(host, timeout=timeout)
+        if tunnel_host:
+            conn.set_tunnel(tunnel_host, headers=tunnel_headers)
+
+        return conn, False
+
+    def put(self, host, tunnel_host, conn):
+        """ method to return a connection that can be reused """
+        with self.lock:
+            conns = self.idle.setdefault((host, tunnel_host), [])
+            if len(conns) < self.size:
+                conns.append((conn, time.time()))
+                return
+
+        conn.close()
+
+
+def _connection_dropped(conn):
+    """ function to check if the server closed an idle connection
+
+    An idle connection has nothing to read, unless the server closed it.
+    Requests that can't be repeated are only safe on connections that pass
+    this check.
+
+    Returns:
+        True if the connection can't be reused
+
+    """
+    if conn.sock is None:
+        return True
+
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+    """ urllib2 handler that sends HTTPS requests over pooled keep-alive
+        connections. Responses are read completely, so that the connection
+        can be reused straight away; error statuses still become HTTPError
+        via urllib2's HTTPErrorProcessor.
+    """
+
+    # requests that may be sent again if their response got lost
+    IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers["Connection"] = "keep-alive"
+
+        tunnel_headers = {}
+        proxy_auth_hdr = "Proxy-Authorization"
+        if proxy_auth_hdr in headers:
+            tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        host = req.get_host()
+        tunnel_host = req._tunnel_host
+        while True:
+            conn, reused = self.pool.get(host, tunnel_host, tunnel_headers, req.timeout)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # the server may have closed an idle connection before we
+                # sent anything, so we try again on a new one.
+                if reused and getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE):
+                    continue
+
+                raise urllib2.URLError(e)
+
+            try:
+                r = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # a connection that was closed while idle gives no status
+                # line at all. the server may still have processed the
+                # request though, so only requests that can safely be
+                # repeated are sent again.
+                if reused and isinstance(e, httplib.BadStatusLine) and \
+                   req.get_method() in self.IDEMPOTENT_METHODS:
+                    continue
+
+                raise urllib2.URLError(e)
+
+            try:
+                body = r.read()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            self.pool.put(host, tunnel_host, conn)
+
+        resp = urllib.addinfourl(StringIO(body), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
 class Request(urllib2.Request):
     """ monkey patched version of urllib2's Request to support HTTP DELETE
         Taken from http://python-requests.org, thanks @kennethreitz
@@ -3,9 +3,12 @@
 # new BSD license
 
 import datetime
+from Queue import Queue
 import random
 import re
 import string
+import sys
+from threading import Event, Lock, Thread
 import urllib2
 
 # first line with non-whitespace should be the title
@@ -26,28 +29,30 @@ def get_note_title(note):
         return ''
 
 def get_note_title_file(note):
-    mo = note_title_re.match(note.get('content', ''))
-    if mo:
-        fn = mo.groups()[0]
-        fn = fn.replace(' ', '_')
-        fn = fn.replace('/', '_')
-        if not fn:
-            return ''
-
-        if isinstance(fn, str):
-            fn = unicode(fn, 'utf-8')
-        else:
-            fn = unicode(fn)
-
-        if note_markdown(note):
-            fn += '.mkdn'
-        else:
-            fn += '.txt'
-
-        return fn
-    else:
+    return note_title_to_file(get_note_title(note), note_markdown(note))
+
+def note_title_to_file(title, markdown):
+    """Return name of the text file for a note with title, see
+    get_note_title(), or '' if the title is empty.
+    """
+
+    fn = title.replace(' ', '_')
+    fn = fn.replace('/', '_')
+    if not fn:
         return ''
 
+    if isinstance(fn, str):
+        fn = unicode(fn, 'utf-8')
+    else:
+        fn = unicode(fn)
+
+    if markdown:
+        fn += '.mkdn'
+    else:
+        fn += '.txt'
+
+    return fn
+
 def human_date(timestamp):
     """
     Given a timestamp, return pretty human format representation.
@@ -124,22 +129,6 @@ def sanitise_tags(tags):
 
 
 
-def sort_by_title_pinned(a, b):
-    if note_pinned(a.note) and not note_pinned(b.note):
-        return -1
-    elif not note_pinned(a.note) and note_pinned(b.note):
-        return 1
-    else:
-        return cmp(get_note_title(a.note), get_note_title(b.note))
-
-def sort_by_modify_date_pinned(a, b):
-    if note_pinned(a.note) and not note_pinned(b.note):
-        return 1
-    elif not note_pinned(a.note) and note_pinned(b.note):
-        return -1
-    else:
-        return cmp(float(a.note.get('modifydate', 0)), float(b.note.get('modifydate', 0)))
-
 def check_internet_on():
     """Utility method to check if we have an internet connection.
     
@@ -154,6 +143,73 @@ def check_internet_on():
     
     return False    
 
+def imap_threaded(func, items, num_threads):
+    """Apply func to each of items on a bounded number of worker threads.
+
+    items is consumed lazily by the workers, so it can be a generator that
+    does slow work of its own. Results are yielded on the calling thread, in
+    the order in which they complete. An exception raised by func or by
+    items is re-raised on the calling thread. When the calling thread stops
+    iterating, the workers stop taking new items.
+
+    @param func: callable taking a single item.
+    @param items: iterable of items.
+    @param num_threads: maximum number of concurrent calls of func.
+    @returns: generator of (item, result) tuples.
+    """
+
+    items = iter(items)
+    items_lock = Lock()
+    stop = Event()
+    q_res = Queue()
+    done = object()
+
+    def worker():
+        try:
+            while not stop.is_set():
+                with items_lock:
+                    try:
+                        item = items.next()
+
+                    except StopIteration:
+                        break
+
+                try:
+                    q_res.put((item, func(item), None))
+
+                except Exception:
+                    q_res.put((item, None, sys.exc_info()))
+
+        except Exception:
+            # items itself failed
+            q_res.put((None, None, sys.exc_info()))
+
+        finally:
+            q_res.put(done)
+
+    num_threads = max(1, num_threads)
+    for i in range(num_threads):
+        t = Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+
+    running = num_threads
+    try:
+        while running:
+            r = q_res.get()
+            if r is done:
+                running -= 1
+                continue
+
+            item, result, exc_info = r
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            yield item, result
+
+    finally:
+        stop.set()
+
 class KeyValueObject:
     """Store key=value pairs in this object and retrieve with o.key.
     
@@ -194,20 +194,33 @@ class StatusBar(tk.Frame):
 
 class NotesList(tk.Frame):
     """
+    The text widget only ever contains the rows that fit in the window,
+    starting at note index top. Scrolling renders a different range of
+    note_headers, so the cost of (re)rendering does not depend on the
+    number of notes in the list.
+
     @ivar note_headers: list containing tuples with each note's title, tags,
     modified date and so forth. Always in sync with what is displayed.
+    @ivar top: index of the note in the first row of the text widget.
     """
 
     TITLE_COL = 0
     TAGS_COL = 1
     MODIFYDATE_COL = 2
     PINNED_COL = 3
+    TAGFOUND_COL = 4
+
+    # rows rendered below the last (partially) visible one, so that small
+    # changes in window size don't leave an empty strip.
+    BUFFER_ROWS = 2
 
     def __init__(self, master, font_family, font_size, config):
         tk.Frame.__init__(self, master)
 
-        yscrollbar = tk.Scrollbar(self)
+        # we drive the scrollbar ourselves, see cmd_yscroll() and render()
+        yscrollbar = tk.Scrollbar(self, command=self.cmd_yscroll)
         yscrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.yscrollbar = yscrollbar
 
         f = tkFont.Font(family=font_family, size=font_size)
         # tkFont.families(root) returns list of available font family names
@@ -216,9 +229,9 @@ class NotesList(tk.Frame):
         self.text = tk.Text(self, height=25, width=30,
             wrap=tk.NONE,
             font=f,
-            yscrollcommand=yscrollbar.set,
             undo=True,
-            background = config.background_color)
+            background = config.background_color,
+            yscrollcommand=self.cmd_text_yscrolled)
         # change default font at runtime with:
         #text.config(font=f)
 
@@ -246,13 +259,13 @@ class NotesList(tk.Frame):
 
         self.text.tag_config("modifydate", foreground="dark gray")
 
-        yscrollbar.config(command=self.text.yview)
-
         self._bind_events()
 
         self.selected_idx = -1
         # list containing tuples with each note's title, tags,
         self.note_headers = []
+        self.top = 0
+        self.render_pending = False
 
         self.layout=config.layout
         self.print_columns=config.print_columns
@@ -264,16 +277,27 @@ class NotesList(tk.Frame):
 
     def append(self, note, config):
         """
+        Add note to the end of the list. It is only rendered when scrolled
+        into view.
+
         @param note: The complete note dictionary.
+        @param config: tagfound and the note's title.
         """
 
-        title = utils.get_note_title(note)
+        title = config.title
         tags = note.get('tags')
         modifydate = float(note.get('modifydate'))
         pinned = utils.note_pinned(note)
-        self.note_headers.append((title, tags, modifydate, pinned))
+        self.note_headers.append((title, tags, modifydate, pinned, config.tagfound))
 
-        self.enable_text()
+        self.schedule_render()
+
+    def helper_insert_row(self, nh):
+        """
+        Insert a single row for note header nh at the end of the text widget.
+        """
+
+        title, tags, modifydate, pinned, tagfound = nh
 
         if self.layout == "vertical" and self.print_columns == 1:
             nrchars, rem = divmod((self.text.winfo_width()), self.cwidth)
@@ -285,7 +309,7 @@ class NotesList(tk.Frame):
             self.text.insert(tk.END, u'{0:<{w}}'.format(title[:cellwidth-1], w=cellwidth), ("title,"))
 
             if tags > 0:
-                if config.tagfound:
+                if tagfound:
                     self.text.insert(tk.END, u'{0:<{w}}'.format(','.join(tags)[:cellwidth-1], w=cellwidth), ("found",))
                 else:
                     self.text.insert(tk.END, u'{0:<{w}}'.format(','.join(tags)[:cellwidth-1], w=cellwidth), ("tags",))
@@ -303,15 +327,97 @@ class NotesList(tk.Frame):
 
             # tags can be None (newly created note) or [] or ['tag1', 'tag2']
             if tags > 0:
-                if config.tagfound:
+                if tagfound:
                     self.text.insert(tk.END, ' ' + ','.join(tags), ("found",))
                 else:
                     self.text.insert(tk.END, ' ' + ','.join(tags), ("tags",))
 
         self.text.insert(tk.END, '\n')
 
+    def get_visible_rows(self):
+        """
+        Number of rows that fit in the text widget.
+        """
+
+        h = self.text.winfo_height()
+        if h <= 1:
+            # not mapped yet, so we go by the requested size
+            return int(self.text.cget('height'))
+
+        linespace = max([f.metrics('linespace') for f in self.fonts])
+        return max(1, h // linespace)
+
+    def schedule_render(self):
+        """
+        Render once Tk is idle, so that many changes lead to one render.
+        """
+
+        if not self.render_pending:
+            self.render_pending = True
+            self.after_idle(self.render)
+
+    def render(self):
+        """
+        Fill the text widget with the rows starting at top.
+        """
+
+        self.render_pending = False
+
+        n = len(self.note_headers)
+        visible = self.get_visible_rows()
+        self.top = max(0, min(self.top, n - visible))
+
+        self.enable_text()
+        self.text.delete(1.0, tk.END)
+        for nh in self.note_headers[self.top:self.top + visible + self.BUFFER_ROWS]:
+            self.helper_insert_row(nh)
+
+        if self.top <= self.selected_idx < self.top + visible + self.BUFFER_ROWS:
+            start, end = self.idx_to_index_range(self.selected_idx)
+            self.text.tag_add("selected", start, end)
+
         self.disable_text()
+        # the text widget itself must never scroll
+        self.text.yview_moveto(0)
+
+        if n:
+            self.yscrollbar.set(float(self.top) / n, float(min(n, self.top + visible)) / n)
+        else:
+            self.yscrollbar.set(0, 1)
+
+    def scroll_to(self, top):
+        self.top = top
+        self.render()
+
+    def cmd_yscroll(self, *args):
+        # called by the scrollbar with ('moveto', fraction) or
+        # ('scroll', number, 'units' or 'pages')
+        if args[0] == 'moveto':
+            self.scroll_to(int(float(args[1]) * len(self.note_headers)))
+
+        elif args[0] == 'scroll':
+            delta = int(args[1])
+            if args[2] == 'pages':
+                delta *= self.get_visible_rows()
 
+            self.scroll_to(self.top + delta)
+
+    def cmd_text_yscrolled(self, first, last):
+        # called by the text widget when its own view moved, e.g. when Tk
+        # scrolls it while the user drags a selection past its edge. the
+        # rows it holds always start at top, so we move it straight back.
+        if float(first) > 0:
+            self.text.yview_moveto(0)
+
+    def cmd_mousewheel(self, event):
+        # X11 sends buttons 4 and 5, the others a delta in event.delta
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.top - 3)
+
+        else:
+            self.scroll_to(self.top + 3)
+
+        return "break"
 
     def _bind_events(self):
         # Text widget events ##########################################
@@ -347,25 +453,32 @@ class NotesList(tk.Frame):
 
         self.text.bind("<Next>", cmd_pagedown)
 
+        # we do all scrolling ourselves
+        self.text.bind("<MouseWheel>", self.cmd_mousewheel)
+        self.text.bind("<Button-4>", self.cmd_mousewheel)
+        self.text.bind("<Button-5>", self.cmd_mousewheel)
+
+        # a different height fits a different number of rows
+        self.text.bind("<Configure>", lambda e: self.schedule_render())
+
 
     def cmd_text_button1(self, event):
         # find line that was clicked on
         text_index = self.text.index("@%d,%d" % (event.x, event.y))
         # go from event coordinate to tkinter text INDEX to note idx!
-        idx = int(text_index.split('.')[0]) - 1
-        self.select(idx, silent=False)
+        idx = self.top + int(text_index.split('.')[0]) - 1
+        if idx < self.get_number_of_notes():
+            self.select(idx, silent=False)
 
 
     def clear(self):
         """
 
         """
-        self.enable_text()
-        # clear everything from the display
-        self.text.delete(1.0, tk.END)
-        # and make sure our backing store is in sync
+        # clear our backing store, the display follows with the next render
         del self.note_headers[:]
-        self.disable_text()
+        self.top = 0
+        self.schedule_render()
 
     def disable_text(self):
         self.text.config(state=tk.DISABLED)
@@ -373,22 +486,6 @@ class NotesList(tk.Frame):
     def enable_text(self):
         self.text.config(state=tk.NORMAL)
 
-    def find_note_by_title(self, title):
-        """
-        Find note with given title.
-
-        @returns: Note index if found, -1 otherwise.
-        """
-
-        idx = -1
-        for i, nh in enumerate(self.note_headers):
-            t = nh[NotesList.TITLE_COL]
-            if t == title:
-                idx = i
-                break
-
-        return idx
-
     def get_number_of_notes(self):
         # could also have used:
         # return int(self.text.index('end-1c').split('.')[0])
@@ -418,11 +515,11 @@ class NotesList(tk.Frame):
     def idx_to_index_range(self, idx):
         """
         Given a note index idx, return the Tkinter text index range for
-        the start and end of that note.
+        the start and end of that note. Only valid if the note is rendered.
         """
 
         # tkinter text first line is 1, but first column is 0
-        row = idx+1
+        row = idx - self.top + 1
         start = "%d.0" % (row,)
         end = "%d.end" % (row,)
 
@@ -433,21 +530,26 @@ class NotesList(tk.Frame):
         @param idx: index of note to select. -1 if no selection.
         """
 
-        # remove tag selected from row 1 (first) and column 0 to the end of the buffer
-        self.text.tag_remove("selected", "1.0", "end")
-
         if idx >= 0 and idx < self.get_number_of_notes():
-            # then add it to the requested note line(s)
-            start, end = self.idx_to_index_range(idx)
-            self.text.tag_add("selected", start, end)
-            # ensure that this is visible
-            self.text.see(start)
-            # and store the current idx
+            # store the current idx
             self.selected_idx = idx
 
+            # ensure that this is visible
+            visible = self.get_visible_rows()
+            if idx < self.top:
+                self.top = idx
+
+            elif idx >= self.top + visible:
+                self.top = idx - visible + 1
+
         else:
             self.selected_idx = -1
 
+        # this also moves the selected tag to the selected note. a render
+        # that is already scheduled picks up the new selection.
+        if not self.render_pending:
+            self.render()
+
         if not silent:
             self.event_generate('<<NotesListSelect>>')
 
@@ -694,13 +796,6 @@ class View(utils.SubjectMixin):
 
         self.notes_list.select(idx, silent)
 
-    def select_note_by_name(self, name):
-        idx = self.notes_list.find_note_by_title(name)
-        if idx >= 0:
-            self.select_note(idx, silent=False)
-
-        return idx
-
     def set_note_status(self, status):
         """status is an object with ivars modified, saved and synced.
         """
@@ -1152,6 +1247,9 @@ class View(utils.SubjectMixin):
         for f in self.fonts:
             f.configure(size=f['size'] + inc_size)
 
+        # a different number of rows fits in the notes list now
+        self.notes_list.schedule_render()
+
     def handler_cs_checkbutton(self, *args):
         self.notify_observers('change:cs',
             utils.KeyValueObject(value=self.cs_checkbutton_var.get()))
@@ -1160,14 +1258,22 @@ class View(utils.SubjectMixin):
         # nvPY will do saving and syncing!
         self.notify_observers('keep:house', None)
         
-        # check if titles need refreshing
+        # check if titles need refreshing. only notes that changed since
+        # our previous check can be out of date.
         refresh_notes_list = False
-        prev_title = None
-        prev_modifydate = None
-        prev_pinned = 0
-        for i,o in enumerate(self.notes_list_model.list):
+        changed = self.notes_list_model.get_changed_keys()
+        rows = self.notes_list_model.get_idxs(changed)
+        for i in rows:
+            o = self.notes_list_model.list[i]
             # order should be the same as our listbox
-            nt = utils.get_note_title(o.note)
+            try:
+                nt = self.notes_list_model.get_note_title(o.key)
+
+            except KeyError:
+                # a full sync removed this note from the database.
+                refresh_notes_list = True
+                break
+
             ot = self.notes_list.get_title(i)
             # if we strike a note with an out-of-date title, redo.
             if nt != ot:
@@ -1202,35 +1308,48 @@ class View(utils.SubjectMixin):
                 refresh_notes_list = True
                 break
 
-            if self.config.sort_mode == 0:
-                # alpha
-                if prev_title is not None and prev_title > nt:
-                    logging.debug("alpha resort triggered")
-                    refresh_notes_list = True
-                    break
-                
-                prev_title = nt
-                
-            else:
+            # a changed note can only have moved out of place with respect
+            # to its neighbours.
+            try:
+                in_order = self.helper_rows_in_order(i - 1, i) and \
+                           self.helper_rows_in_order(i, i + 1)
 
-                # we go from top to bottom, newest to oldest
-                # this means that prev_modifydate (above) needs to be larger
-                # than md (below). if it's not, re-sort.
-                if prev_modifydate is not None and prev_modifydate < md and \
-                   not prev_pinned:
-                    logging.debug("modifydate resort triggered")
-                    refresh_notes_list = True
-                    break
-                
-                prev_modifydate = md
-                if self.config.pinned_ontop:
-                    prev_pinned = utils.note_pinned(o.note)
+            except KeyError:
+                refresh_notes_list = True
+                break
+
+            if not in_order:
+                logging.debug("resort triggered")
+                refresh_notes_list = True
+                break
             
         if refresh_notes_list:
             self.refresh_notes_list()
         
         self.root.after(self.config.housekeeping_interval_ms, self.handler_housekeeper)
         
+    def helper_rows_in_order(self, i, j):
+        """Are rows i and j of the notes list, with i above j, in the order
+        selected by sort_mode and pinned_ontop?
+        """
+
+        nl = self.notes_list_model.list
+        if i < 0 or j >= len(nl):
+            return True
+
+        oi, oj = nl[i], nl[j]
+        if self.config.pinned_ontop and utils.note_pinned(oi.note) != utils.note_pinned(oj.note):
+            return utils.note_pinned(oi.note)
+
+        if self.config.sort_mode == 0:
+            # alpha
+            get_note_title = self.notes_list_model.get_note_title
+            return get_note_title(oi.key) <= get_note_title(oj.key)
+
+        else:
+            # we go from top to bottom, newest to oldest
+            return float(oi.note.get('modifydate', 0)) >= float(oj.note.get('modifydate', 0))
+
     def handler_pinned_checkbutton(self, *args):
         self.notify_observers('change:pinned',
             utils.KeyValueObject(value=self.pinned_checkbutton_var.get()))
@@ -1400,6 +1519,11 @@ class View(utils.SubjectMixin):
             # re-render!
             self.set_notes(notes_list_model.list)
             
+    def after(self, ms, func):
+        """Call func on the Tk thread after ms milliseconds.
+        """
+        return self.root.after(ms, func)
+
     def main_loop(self):
         self.root.mainloop()
 
@@ -1473,12 +1597,15 @@ class View(utils.SubjectMixin):
         self.notes_list.clear()
         taglist = []
 
+        get_note_title = self.notes_list_model.get_note_title
         for o in notes:
             tags = o.note.get('tags')
             if tags:
                 taglist += tags
 
-            self.notes_list.append(o.note, utils.KeyValueObject(tagfound=o.tagfound))
+
+            self.notes_list.append(o.note, utils.KeyValueObject(tagfound=o.tagfound,
+                title=get_note_title(o.key)))
 
         if self.taglist is None:
             # first time we get called, so we need to initialise